@@ -28,6 +28,8 @@ set SCRDIR=scr
 set MOVIES_SCRIP=%SCRDIR%\aux_movies.py
 set FIGURES_SCRIPT=%SCRDIR%\aux_figures.py
 set VALIDATION_SCRIPT=%SCRDIR%\validate.py
+set BENCHMARK_SCRIPT=%SCRDIR%\benchmark.py
+set BENCH_COMPARE_SCRIPT=%SCRDIR%\bench_compare.py
 
 rem use NUMBER_OF_PROCESSES to set PARALLEL
 if %NUMBER_OF_PROCESSES% gtr 1 (
@@ -165,10 +167,49 @@ rem     Setting test in simulation mode scan
    make back
    copy templates\script_Policht2021_test_scan.yaml .\script_Policht2021.yaml
 
+rem     Setting test of omega2 maps by projection (validated as single)
+) else if %task% == set_test_projection (
+   make back
+   copy templates\script_Policht2021_test_projection.yaml .\script_Policht2021.yaml
+
+rem     Setting test of streaming omega2 maps (validated as single)
+) else if %task% == set_test_streaming (
+   make back
+   copy templates\script_Policht2021_test_streaming.yaml .\script_Policht2021.yaml
+
+rem     Setting test of t2 propagation by diagonalization (validated as single)
+) else if %task% == set_test_diag (
+   make back
+   copy templates\script_Policht2021_test_diag.yaml .\script_Policht2021.yaml
+
+rem     Setting test of the spectral library (the scan is run first)
+) else if %task% == set_test_library (
+   make back
+   copy templates\script_Policht2021_test_library_scan.yaml .\script_Policht2021.yaml
+
+rem     Setting test of the scan run twice into the same directory
+) else if %task% == set_test_scan_rerun (
+   make back
+   copy templates\script_Policht2021_test_scan_rerun.yaml .\script_Policht2021.yaml
+
+rem     Setting test of disorder in batches with checkpoints
+) else if %task% == set_test_disorder_batch (
+   make back
+   copy templates\data_test_disorder\random_state.qrp .\
+   copy templates\script_Policht2021_test_disorder_batch.yaml .\script_Policht2021.yaml
+
 rem     Validating results against saved data
 ) else if %task% == validate (
    %PYTHON% %VALIDATION_SCRIPT% %2
 
+rem     Benchmarks of the test calculations
+) else if %task% == benchmark (
+   %PYTHON% %BENCHMARK_SCRIPT%
+
+rem     Comparison of two benchmarks
+) else if %task% == bench_compare (
+   %PYTHON% %BENCH_COMPARE_SCRIPT% %2 %3
+
 rem     Test scan
 ) else if %task% == test_scan (
    make set_test_scan
@@ -193,12 +234,69 @@ rem     Test disorder
    make clean
    echo test_disorder ended with success >> test.log
 
+rem     Test projection
+) else if %task% == test_projection (
+   make set_test_projection
+   make run
+   make validate
+   make clean
+   echo test_projection ended with success >> test.log
+
+rem     Test streaming
+) else if %task% == test_streaming (
+   make set_test_streaming
+   make run
+   make validate
+   make clean
+   echo test_streaming ended with success >> test.log
+
+rem     Test of t2 propagation by diagonalization
+) else if %task% == test_diag (
+   make set_test_diag
+   make run
+   make validate
+   make clean
+   echo test_diag ended with success >> test.log
+
+rem     Test of disorder averaging from the spectral library of a scan
+) else if %task% == test_library (
+   make set_test_library
+   make run
+   copy templates\script_Policht2021_test_library.yaml .\script_Policht2021.yaml
+   make run
+   make validate
+   make clean
+   echo test_library ended with success >> test.log
+
+rem     Test of the scan run twice into the same directory
+) else if %task% == test_scan_rerun (
+   make set_test_scan_rerun
+   make run
+   make run
+   make validate
+   make clean
+   echo test_scan_rerun ended with success >> test.log
+
+rem     Test of disorder in batches with checkpoints
+) else if %task% == test_disorder_batch (
+   make set_test_disorder_batch
+   make run
+   make validate
+   make clean
+   echo test_disorder_batch ended with success >> test.log
+
 rem     Complete set of tests
 ) else if %task% == test (
    make purge
    make test_single
    make test_disorder
    make test_scan
+   make test_projection
+   make test_streaming
+   make test_diag
+   make test_library
+   make test_scan_rerun
+   make test_disorder_batch
 
 rem     Setting example in simulation mode single
 ) else if %task% == set_example_single (
@@ -252,6 +350,15 @@ rem    Help message
    echo     ^(see configureation yaml file^). results_directory is
    echo     the directory containing results of Quantarhei simulation.
    echo.
+   echo ^> make benchmark
+   echo.
+   echo     Runs the test calculations with varied parameters and
+   echo     saves their timings and memory into benchmark_^<time^>.json
+   echo.
+   echo ^> make bench_compare benchmark_file_1 benchmark_file_2
+   echo.
+   echo     Compares two benchmarks and reports regressions
+   echo.
    echo ^> make clean
    echo.
    echo     Deletes the output of the simulations
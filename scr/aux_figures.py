@@ -44,11 +44,17 @@
 
 import scipy.io as io
 import matplotlib as mpl
+mpl.use("Agg")
+import matplotlib.pyplot as plt
 import sys, os
+import hashlib
+import multiprocessing
 import numpy
 
 import quantarhei as qr
 
+import result_store
+
 ###############################################################################
 #
 #  ADVANCED CONFIGURATION SECTION
@@ -64,6 +70,14 @@ window=[10500,13550,10500,13550]
 #cmpfile = None
 cmpfile = os.path.join("scr", "parula_colormap.dat") #"parula_colormap.mat"
 
+# number of processes plotting the figures (0 means one per core)
+Nworkers = 0
+
+# figures are plotted only if their data, the output directory they come
+# from or the configuration above changed since the last run; the hashes of
+# the plotted figures are kept in this file
+cache_file = "fig_cache.qrp"
+
 ###############################################################################
 #
 #  END OF CONFIGURATION SECTION
@@ -112,6 +126,56 @@ if cmpfile is not None:
 else:
     cmap = None
 
+#
+# Figures are described by jobs (file name, source of the spectrum), where
+# the source is ("single", component, index) or ("average", file name)
+#
+spectra = dict()
+
+def get_spectrum(source):
+    """Returns the normalized spectrum of a figure
+    """
+    if source[0] == "single":
+        sp = spectra[source[1]][source[2]]
+        sp.normalize2(dpart=qr.part_ABS)
+    else:
+        sp = qr.load_parcel(source[1])
+        mx = numpy.max(numpy.abs(sp.data))
+        sp.data = sp.data/mx
+    return sp
+
+
+def figure_key(source):
+    """Hash of the data of a figure, its directory and the configuration
+    """
+    if source[0] == "single":
+        data = spectra[source[1]][source[2]].data
+    else:
+        data = qr.load_parcel(source[1]).data
+    hsh = hashlib.sha1(numpy.ascontiguousarray(data).tobytes())
+    hsh.update(repr((os.path.abspath(target_dir), Ncont, window,
+                     cmpfile)).encode())
+    return hsh.hexdigest()
+
+
+def plot_figure(job):
+    """Plots and saves the figure of a job
+    """
+    global fig
+    (file_name, source) = job
+    if fig is None:
+        fig = plt.figure()
+
+    sp = get_spectrum(source)
+    with qr.energy_units("1/cm"):
+        sp.plot(fig=fig, spart=qr.part_ABS, Npos_contours=Ncont,
+                window=window, cmap=cmap, vmin_ratio=0.0)
+    sp.savefig(file_name)
+    return file_name
+
+
+jobs = []
+
 try:
 
     print("\nLooking for single realization files ...")
@@ -119,47 +183,46 @@ try:
 
         print("\nSignal component:", ext[ext_i])
 
-        cont = qr.TwoDSpectrumContainer()
-        cont.use_indexing_type("integer")
+        if do_nodes and result_store.has_store(target_dir):
+            # spectra are loaded one by one when they are plotted
+            print("Loading result store:", target_dir)
+            spectra[ext_i] = result_store.LazySpectra(target_dir, ext[ext_i])
+            names = [str(tag) for tag in spectra[ext_i].tags]
 
-        ii = 0
-        for node in nodes:
+        else:
+            sps = []
+            for node in nodes:
 
-            if do_nodes:
-                ndp = "_"+str(node)
-            else:
-                ndp = ""
-
-            file_name = os.path.join(target_dir, prefix+ext[ext_i]+ndp+".qrp")
-            print("Loading file:", file_name)
-            conta = qr.load_parcel(file_name)
-
-            for tag in conta.spectra:
-                #print("(node, tag, new tag):", node, tag, ii)
-                sp = conta.get_spectrum(tag)
-                ntag = ii
-                cont.set_spectrum(sp, tag=ntag)
-                ii += 1
-
-        #print("Summary ("+ext[ext_i]+"):")
-        for tag in cont.spectra:
-
-            sp = cont.get_spectrum(tag)
-            #print(tag, sp.params["dE"])
-            sp.normalize2(dpart=qr.part_ABS)
-            with qr.energy_units("1/cm"):
-                if fig is None:
-                    fig = sp.plot(spart=qr.part_ABS, Npos_contours=Ncont,
-                                  window=window,
-                                  cmap=cmap, vmin_ratio=0.0)
+                if do_nodes:
+                    ndp = "_"+str(node)
                 else:
-                    fig  = sp.plot(fig=fig)
+                    ndp = ""
+
+                file_name = os.path.join(target_dir,
+                                         prefix+ext[ext_i]+ndp+".qrp")
+                print("Loading file:", file_name)
+                conta = qr.load_parcel(file_name)
+
+                for tag in conta.spectra:
+                    sps.append((tag, str(node)+"_"+str(tag),
+                                conta.get_spectrum(tag)))
+
+            # tags unique over the nodes are the indices of the scan points;
+            # otherwise the figures are named also by the node
+            if len(set([tag for (tag, name, sp) in sps])) == len(sps):
+                sps.sort(key=lambda tsp: tsp[0])
+                names = [str(tag) for (tag, name, sp) in sps]
+            else:
+                names = [name for (tag, name, sp) in sps]
+            spectra[ext_i] = [sp for (tag, name, sp) in sps]
 
-            file_name = ("fig_"+ext[ext_i]+postfix+"_cont="
+        # one figure per spectrum (named by its tag)
+        for ntag in range(len(spectra[ext_i])):
+            file_name = ("fig_"+ext[ext_i]+postfix+"_"+names[ntag]+"_cont="
                          +str(Ncont)+".png")
-            print("Saving file:", file_name)
-            sp.savefig(file_name)
-    print("\n... single realization files processed")
+            jobs.append((file_name, ("single", ext_i, ntag)))
+
+    print("\n... single realization files found")
 except:
     print("\nNo single spectrum files found")
 
@@ -177,27 +240,55 @@ try:
         print("\nSignal component:", fsign+"_"+tsigl)
 
         floc = os.path.join(dname,fname)
-        print("Loading file:", floc)
-        av = qr.load_parcel(floc)
-
-        mx = numpy.max(numpy.abs(av.data))
-        av.data = av.data/mx
-
-        try:
-            with qr.energy_units("1/cm"):
-                av.plot(spart=qr.part_ABS, Npos_contours=Ncont, window=window,
-                cmap=cmap, vmin_ratio=0.0)
-                flname = ("fig_"+fsign+"_"+tsigl+
-                          "_average_cont="+str(Ncont)+".png")
-                print("Saving file: ",flname)
-                av.savefig(flname)
-        except:
+        if not os.path.exists(floc):
             raise Exception()
+        print("Found file:", floc)
 
-    print("\n... averaged spectra processed")
+        flname = ("fig_"+fsign+"_"+tsigl+
+                  "_average_cont="+str(Ncont)+".png")
+        jobs.append((flname, ("average", floc)))
+
+    print("\n... averaged spectra found")
 except:
     print("\nNo averaged spectrum files found")
 
 
+#
+# Plotting figures whose data or configuration changed
+#
+try:
+    cache = qr.load_parcel(cache_file)
+except:
+    cache = dict()
+
+todo = []
+keys = dict()
+for (file_name, source) in jobs:
+    keys[file_name] = figure_key(source)
+    if os.path.exists(file_name) and (cache.get(file_name) == keys[file_name]):
+        continue
+    todo.append((file_name, source))
+print("\nPlotting", len(todo), "of", len(jobs), "figures (others unchanged)")
+
+if (len(todo) > 1) and ("fork" in multiprocessing.get_all_start_methods()):
+    if Nworkers == 0:
+        Nworkers = os.cpu_count()
+    pool = multiprocessing.get_context("fork").Pool(Nworkers)
+    done = pool.imap_unordered(plot_figure, todo)
+else:
+    # without fork (Windows), the figures are plotted by this process
+    pool = None
+    done = map(plot_figure, todo)
+
+for file_name in done:
+    print("Saving file:", file_name)
+    cache[file_name] = keys[file_name]
+
+if pool is not None:
+    pool.close()
+    pool.join()
+qr.save_parcel(cache, cache_file)
+
+
 print("\n       ... finished")
 print("===============================")
@@ -1,14 +1,20 @@
 
 import matplotlib
+matplotlib.use("Agg")
 matplotlib.rcParams['text.usetex'] = True
 import scipy.io as io
 import numpy
 import matplotlib as mpl
+import matplotlib.pyplot as plt
 import sys
 import os
+import subprocess
+import multiprocessing
 
 import quantarhei as qr
 
+import result_store
+
 ################################################################################
 #
 #  ADVANCED CONFIGURATION SECTION
@@ -27,6 +33,13 @@ cmpfile = os.path.join("scr","parula_colormap.dat")
 # movie format (mp4 or mov)
 movie_ext = "mov"
 
+# frame rate and resolution (dots per inch) of the movies
+frate = 20
+dpi = 50
+
+# number of processes rendering the frames (0 means one per core)
+Nworkers = 0
+
 ###############################################################################
 #
 #  END OF CONFIGURATION SECTION
@@ -85,19 +98,60 @@ if do_nodes:
 else:
     nodes = [0]
 
-print("\n*** Making energy gap scan movie ***\n")
+#
+# Frames of the movies of all signal components are rendered by a pool of
+# processes and streamed as raw RGB data into ffmpeg, one encoder per
+# movie
+#
+fig = None
 
-for ext_i in ext:
+def render_frame(task):
+    """Renders a frame and returns its width, height and RGB data
+
+    `task` is (component, index of the spectrum, maximum of the color scale)
+    """
+    global fig
+    (ext_i, kk, mx) = task
+    if fig is None:
+        fig = plt.figure(dpi=dpi)
+
+    sp = spectra[ext_i][kk]
+    (label, text_loc) = label_func(sp)
+    with qr.energy_units("1/cm"):
+        sp.plot(fig=fig, cmap=cmap, vmax=mx, spart=qr.part_ABS,
+                Npos_contours=Ncont, show_states=show_states_func(sp),
+                label=label, text_loc=text_loc)
+    fig.canvas.draw()
+    (width, height) = fig.canvas.get_width_height()
+    rgb = numpy.asarray(fig.canvas.buffer_rgba())[:,:,:3]
+    return (width, height, rgb.tobytes())
+
+
+def open_encoder(mfilename, width, height):
+    """Starts ffmpeg encoding raw RGB frames from its standard input
+    """
+    cmd = [mpl.rcParams["animation.ffmpeg_path"], "-y", "-loglevel", "error",
+           "-f", "rawvideo", "-pix_fmt", "rgb24",
+           "-s", str(width)+"x"+str(height), "-r", str(frate), "-i", "-",
+           "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+           "-vcodec", mpl.rcParams["animation.codec"], "-pix_fmt", "yuv420p",
+           mfilename]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE)
 
-    cont = qr.TwoDSpectrumContainer()
-    cont.use_indexing_type("integer")
 
+def load_spectra(ext_i):
+    """Returns the sequence of the spectra of the component `ext_i`
+    """
+    print("Collecting spectra of the component", ext[ext_i], "...")
+    if result_store.has_store(target_dir):
+        # spectra are loaded one by one when the frames are drawn
+        return result_store.LazySpectra(target_dir, ext[ext_i],
+                                        normalize=normalize)
 
     #
     # Unite nodes
     #
-    ii = 0
-    print("Creating spectral container ...")
+    sps = []
     for node in nodes:
 
         if do_nodes:
@@ -109,26 +163,86 @@ for ext_i in ext:
         conta = qr.load_parcel(file_name)
 
         for tag in conta.spectra:
-            #print(node, tag, ii)
-            sp = conta.get_spectrum(tag)
-            #print("dE = ", sp.params["dE"])
-            ntag = ii
+            sps.append((tag, conta.get_spectrum(tag)))
 
-            if normalize:
-                sp.normalize2(dpart=qr.part_ABS)
+    # tags unique over the nodes are the indices of the scan points
+    if len(set([tag for (tag, sp) in sps])) == len(sps):
+        sps.sort(key=lambda tsp: tsp[0])
 
-            cont.set_spectrum(sp, tag=ntag)
-            ii += 1
+    for (tag, sp) in sps:
+        if normalize:
+            sp.normalize2(dpart=qr.part_ABS)
+    return [sp for (tag, sp) in sps]
 
-    mfilename = "movie_"+ext[ext_i]+"_cont="+str(Ncont)+"."+movie_ext
-    print("Exporting movie: ", mfilename)
-    #
-    # make a united movie
-    #
-    with qr.energy_units("1/cm"):
-        cont.make_movie(mfilename, cmap=cmap,
-        spart=qr.part_ABS, Npos_contours=Ncont, label_func=label_func,
-        show_states_func=show_states_func, dpi=50)
-    print("...done\n")
+
+def make_movies(group):
+    """Renders and encodes the movies of the components in `group`
+    """
+    # frames of the components interleaved, so that the movies progress
+    # together
+    Nframes = max([len(spectra[ext_i]) for ext_i in group])
+    tasks = [(ext_i, kk, vmax[ext_i]) for kk in range(Nframes)
+             for ext_i in group if kk < len(spectra[ext_i])]
+
+    # the pool is started after the spectra are loaded, so that its
+    # processes see them
+    nw = Nworkers
+    if "fork" in multiprocessing.get_all_start_methods():
+        if nw == 0:
+            nw = os.cpu_count()
+        pool = multiprocessing.get_context("fork").Pool(nw)
+        frames = pool.imap(render_frame, tasks)
+        print("Rendering", len(tasks), "frames with", nw, "processes")
+    else:
+        # without fork (Windows), the frames are rendered by this process
+        pool = None
+        frames = map(render_frame, tasks)
+        print("Rendering", len(tasks), "frames")
+
+    encoders = dict()
+    for ((ext_i, kk, mx), (width, height, rgb)) in zip(tasks, frames):
+        if ext_i not in encoders:
+            mfilename = "movie_"+ext[ext_i]+"_cont="+str(Ncont)+"."+movie_ext
+            print("Exporting movie: ", mfilename)
+            encoders[ext_i] = open_encoder(mfilename, width, height)
+        encoders[ext_i].stdin.write(rgb)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    for ext_i in encoders:
+        encoders[ext_i].stdin.close()
+        if encoders[ext_i].wait() != 0:
+            raise Exception("Encoding of the movie "+ext[ext_i]+" failed")
+
+
+print("\n*** Making energy gap scan movie ***\n")
+
+if result_store.has_store(target_dir):
+    # spectra of the store are loaded lazily, all movies are made together
+    groups = [list(ext)]
+else:
+    # containers are loaded whole, so that the movies are made one by one
+    # to keep only one component in memory
+    groups = [[ext_i] for ext_i in ext]
+
+for group in groups:
+    spectra = dict()
+    vmax = dict()
+    for ext_i in group:
+        spectra[ext_i] = load_spectra(ext_i)
+
+        # common color scale of all frames
+        if normalize:
+            vmax[ext_i] = 1.0
+        else:
+            vmax[ext_i] = max([numpy.amax(numpy.abs(sp.data))
+                               for sp in spectra[ext_i]])
+
+    make_movies(group)
+    spectra = None
+
+print("...done\n")
 
 print("... finished")
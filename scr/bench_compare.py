@@ -0,0 +1,118 @@
+###############################################################################
+#
+#  Comparison of two benchmarks
+#
+###############################################################################
+#
+#  HOW RUN THIS SCRIPT
+#  -------------------
+#
+#  Use the Makefile in the parent directory of this script. On Linux/Unix/Mac
+#  systems you type
+#
+#  > make bench_compare OLD=benchmark_file_1 NEW=benchmark_file_2
+#
+#  the same on Windows reads
+#
+#  > make bench_compare benchmark_file_1 benchmark_file_2
+#
+#  The calculations of the two files produced by scr/benchmark.py are
+#  matched by their mode and the value of the swept parameter. Their wall
+#  time, peak memory and the stages of the calculation are compared, and
+#  every quantity which grew by more than the relative threshold (and by
+#  more than the absolute limits below) is reported as a regression. The
+#  threshold can be given as the third argument of the script. The script
+#  exits with a non-zero code if a regression is found.
+#
+
+import sys
+import json
+
+###############################################################################
+#
+#  CONFIGURATION SECTION
+#
+###############################################################################
+
+# relative increase reported as a regression
+threshold = 0.1
+
+# increases smaller than these are not reported (times in sec, memory in MB)
+min_time = 0.5
+min_memory = 10.0
+
+###############################################################################
+#
+#  END OF CONFIGURATION SECTION
+#
+###############################################################################
+
+if len(sys.argv) < 3:
+    print("Usage: python bench_compare.py old_benchmark new_benchmark"+
+          " [threshold]")
+    sys.exit(-1)
+
+if len(sys.argv) > 3:
+    threshold = float(sys.argv[3])
+
+old = json.load(open(sys.argv[1]))
+new = json.load(open(sys.argv[2]))
+
+
+def run_key(rec):
+    """Key identifying the calculation in both benchmarks
+    """
+    return (rec["mode"], rec["parameter"], str(rec["value"]))
+
+
+def quantities(rec):
+    """Compared quantities of a calculation with their absolute limits
+    """
+    qnt = dict(wall=(rec["wall"], min_time),
+               peak_rss_MB=(rec["peak_rss_MB"], min_memory))
+    for stage in rec["stages"]:
+        qnt[stage] = (rec["stages"][stage], min_time)
+    return qnt
+
+
+print("\nComparing benchmarks")
+print("--------------------")
+print("old:", sys.argv[1], "(commit", str(old["environment"]["commit"])+")")
+print("new:", sys.argv[2], "(commit", str(new["environment"]["commit"])+")")
+if old["environment"]["platform"] != new["environment"]["platform"]:
+    print("Warning: the benchmarks were run on different platforms")
+print("\nRegression threshold:", "%.1f" % (100*threshold), "%\n")
+
+old_runs = dict([(run_key(rec), rec) for rec in old["runs"]])
+
+regressions = 0
+print("%-10s %-16s %-8s %-14s %12s %12s %9s" % ("mode", "parameter", "value",
+      "quantity", "old", "new", "change"))
+for rec in new["runs"]:
+    key = run_key(rec)
+    if key not in old_runs:
+        continue
+    orec = old_runs[key]
+    if (rec["exit_code"] != 0) or (orec["exit_code"] != 0):
+        print("%-10s %-16s %-8s failed (exit codes %s and %s)" %
+              (key + (orec["exit_code"], rec["exit_code"])))
+        continue
+
+    oqnt = quantities(orec)
+    for (name, (val, limit)) in quantities(rec).items():
+        if (name not in oqnt) or (val is None) or (oqnt[name][0] is None):
+            continue
+        oval = oqnt[name][0]
+        change = (val - oval)/oval if oval > 0.0 else 0.0
+        flag = ""
+        if (change > threshold) and (val - oval > limit):
+            flag = "REGRESSION"
+            regressions += 1
+        print("%-10s %-16s %-8s %-14s %12.3f %12.3f %8.1f%% %s" %
+              (key + (name, oval, val, 100*change, flag)))
+
+print()
+if regressions > 0:
+    print("Found", regressions, "regression(s)!!!\n")
+    sys.exit(1)
+print("No regressions found\n")
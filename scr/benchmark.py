@@ -0,0 +1,282 @@
+###############################################################################
+#
+#  Benchmarks of the simulation script
+#
+###############################################################################
+#
+#  HOW RUN THIS SCRIPT
+#  -------------------
+#
+#  Use the Makefile in the parent directory of this script. On Linux/Unix/Mac
+#  systems you type
+#
+#  > make benchmark
+#
+#  the same on Windows reads
+#
+#  > make benchmark
+#
+#  The test input files templates/script_Policht2021_test_<mode>.yaml are
+#  run with the parameters listed in the configuration section below changed
+#  one at a time (all other parameters keep the values of the test input
+#  files). Each calculation runs in a temporary directory with the option
+#  "instrumentation" switched on. Its wall time, peak memory (resident set
+#  size) and the times of its stages (from the file stage_profile.json of
+#  the script, under the names "run:<stage>") are saved with the description
+#  of the computer into the file benchmark_<time>.json, and the scaling of
+#  the wall time with each parameter is plotted into the files
+#  bench_<mode>_<parameter>.png. Two benchmark files are compared by
+#
+#  > make bench_compare OLD=benchmark_file_1 NEW=benchmark_file_2
+#
+#  on Linux/Unix/Mac, or
+#
+#  > make bench_compare benchmark_file_1 benchmark_file_2
+#
+#  on Windows (see scr/bench_compare.py).
+#
+
+import sys
+import os
+import re
+import glob
+import time
+import datetime
+import json
+import shutil
+import tempfile
+import platform
+import subprocess
+
+import numpy
+import yaml
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+import quantarhei as qr
+
+###############################################################################
+#
+#  ADVANCED CONFIGURATION SECTION
+#
+###############################################################################
+
+# simulation modes to benchmark (test input files in templates)
+modes = ["single", "scan", "disorder"]
+
+# parameters changed one at a time and their values; t1_N_steps sets also
+# t3_N_steps, no_e_vib is the number of vibrational levels in the excited
+# state, trimer switches the trimer model on and off, processes is the
+# number of processes (see processes_backend)
+sweeps = dict(t1_N_steps=[50, 100, 200],
+              t2_N_steps=[5, 10, 20],
+              fine_splitting=[5, 10, 20],
+              no_e_vib=[2, 3],
+              trimer=[False, True],
+              processes=[1, 2])
+
+# each calculation is repeated and the shortest wall time is used
+repeat = 1
+
+# "qrhei" runs the script as "make run" does; "python" runs the script
+# directly
+launcher = "qrhei"
+
+# "processes" sweeps the local processes of parallel_backend "processes";
+# "mpi" sweeps the MPI processes started by "qrhei run -p -n" (requires
+# the "qrhei" launcher, mpi4py and MPI; without them the sweep is skipped)
+processes_backend = "processes"
+
+###############################################################################
+#
+#  END OF CONFIGURATION SECTION
+#
+###############################################################################
+
+script = "script_Policht2021.py"
+input_file = "script_Policht2021.yaml"
+
+
+def set_parameter(inp, par, val):
+    """Sets the value of a swept parameter in the input dictionary
+    """
+    if par == "t1_N_steps":
+        inp["t1_N_steps"] = val
+        inp["t3_N_steps"] = val
+    elif par == "no_e_vib":
+        inp["vibmode"]["no_e_vib"] = val
+    elif par == "trimer":
+        inp["trimer"]["useit"] = val
+    elif par == "processes":
+        if processes_backend == "processes":
+            inp["parallel_backend"] = "processes"
+            inp["parallel_workers"] = val
+    else:
+        inp[par] = val
+
+
+def run_command(par, val):
+    """Returns the command running the script
+    """
+    if launcher == "python":
+        return [sys.executable, script]
+    if (par == "processes") and (processes_backend == "mpi") and (val > 1):
+        if sys.platform == "win32":
+            return ["qrhei", "run", "-p", "-n", str(val), "-d", "mpiexec",
+                    input_file]
+        return ["qrhei", "run", "-p", "-n", str(val), input_file]
+    return ["qrhei", "run", input_file]
+
+
+def parse_log(log):
+    """Returns the breakdown of the time from the output of the script
+    """
+    stages = dict()
+    mt = re.search(r"finished simulation set at .* in ([0-9.eE+-]+) sec", log)
+    if mt is not None:
+        stages["simulation"] = float(mt.group(1))
+    mt = re.search(r"busy time min/mean/max: ([0-9.eE+-]+) ([0-9.eE+-]+)"+
+                   r" ([0-9.eE+-]+)", log)
+    if mt is not None:
+        stages["tasks_max"] = float(mt.group(3))
+    return stages
+
+
+def run_case(mode, par=None, val=None):
+    """Runs a calculation in a temporary directory and returns its record
+    """
+    inp = yaml.safe_load(open(os.path.join("templates", "script_Policht2021"+
+                                           "_test_"+mode+".yaml")))
+    inp["instrumentation"] = True
+    if par is not None:
+        set_parameter(inp, par, val)
+
+    walls = []
+    for rep in range(repeat):
+        wdir = tempfile.mkdtemp(prefix="bench_")
+        shutil.copy2(script, wdir)
+        with open(os.path.join(wdir, input_file), "w") as f:
+            yaml.safe_dump(inp, f)
+        if mode == "disorder":
+            shutil.copy2(os.path.join("templates", "data_test_disorder",
+                                      "random_state.qrp"), wdir)
+
+        t0 = time.time()
+        with open(os.path.join(wdir, "run.log"), "w") as log:
+            proc = subprocess.Popen(run_command(par, val), cwd=wdir,
+                                    stdout=log, stderr=subprocess.STDOUT)
+            if hasattr(os, "wait4"):
+                # resource usage of this calculation only
+                (pid, status, usage) = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                if sys.platform == "darwin":
+                    rss = usage.ru_maxrss/2.0**20
+                else:
+                    rss = usage.ru_maxrss/2.0**10
+            else:
+                proc.wait()
+                rss = None
+        walls.append(time.time()-t0)
+
+        with open(os.path.join(wdir, "run.log")) as log:
+            stages = parse_log(log.read())
+        pnames = glob.glob(os.path.join(wdir, "sim_*", "stage_profile.json"))
+        for pname in pnames:
+            with open(pname) as f:
+                prof = json.load(f)
+            for name in prof["stages"]:
+                stages["run:"+name] = prof["stages"][name]["time"]
+        shutil.rmtree(wdir, ignore_errors=True)
+
+        # qrhei returns zero even when the script fails, so that the run
+        # is failed also when its final output or its profile is missing
+        if (proc.returncode == 0) and (("simulation" not in stages) or
+                                       (len(pnames) == 0)):
+            proc.returncode = 1
+        if proc.returncode != 0:
+            break
+
+    rec = dict(mode=mode, parameter=par, value=val, wall=min(walls),
+               walls=walls, peak_rss_MB=rss, stages=stages,
+               exit_code=proc.returncode)
+    print("   ", mode, par, val, ": wall time", "%.3f" % rec["wall"], "sec;",
+          "peak memory", "n/a" if rss is None else "%.1f MB" % rss,
+          "(FAILED)" if proc.returncode else "")
+    return rec
+
+
+def environment():
+    """Description of the computer and the versions of the software
+    """
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         stderr=subprocess.DEVNULL)
+        commit = commit.decode().strip()
+    except:
+        commit = None
+    return dict(platform=platform.platform(), machine=platform.machine(),
+                processor=platform.processor(), cpu_count=os.cpu_count(),
+                python=platform.python_version(), numpy=numpy.__version__,
+                quantarhei=qr.Manager().version, commit=commit,
+                launcher=launcher, processes_backend=processes_backend,
+                repeat=repeat)
+
+
+def plot_scaling(records, fname_prefix="bench"):
+    """Plots the wall time against the values of the swept parameters
+    """
+    for mode in modes:
+        for par in sweeps:
+            recs = [rec for rec in records if (rec["mode"] == mode) and
+                    (rec["parameter"] == par) and (rec["exit_code"] == 0)]
+            if len(recs) < 2:
+                continue
+            xx = [float(rec["value"]) for rec in recs]
+            yy = [rec["wall"] for rec in recs]
+            plt.figure()
+            plt.plot(xx, yy, "o-")
+            plt.xlabel(par)
+            plt.ylabel("wall time [s]")
+            plt.title(mode)
+            plt.savefig(fname_prefix+"_"+mode+"_"+par+".png",
+                        bbox_inches="tight")
+            plt.close()
+
+
+print()
+print("===============================")
+print("      Running benchmarks")
+print("===============================")
+
+# MPI processes can be swept only if MPI is available
+if ("processes" in sweeps) and (processes_backend == "mpi"):
+    if launcher != "qrhei":
+        print("\nThe sweep of MPI processes requires the qrhei launcher;"+
+              " skipping it")
+        del sweeps["processes"]
+    elif subprocess.call([sys.executable, os.path.join("scr", "probe_mpi.py")],
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL) != 0:
+        print("\nMPI not found (mpi4py package or MPI implementation is"+
+              " missing); skipping the sweep of MPI processes")
+        del sweeps["processes"]
+
+records = []
+for mode in modes:
+    print("\nMode:", mode)
+    records.append(run_case(mode))
+    for par in sweeps:
+        for val in sweeps[par]:
+            records.append(run_case(mode, par, val))
+
+at = '{0:%Y-%m-%d_%H%M%S}'.format(datetime.datetime.now())
+fname = "benchmark_"+at+".json"
+with open(fname, "w") as f:
+    json.dump(dict(environment=environment(), sweeps=sweeps, runs=records),
+              f, indent=1)
+print("\nBenchmark saved into:", fname)
+plot_scaling(records)
+
+print("\n       ... finished")
+print("===============================")
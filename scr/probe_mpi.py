@@ -10,6 +10,7 @@ return_value = 0
 
 def _try_cmd(cmd):
     ret = False
+    retval = 1
     try:
         p = subprocess.Popen(cmd,
                          shell=True, stdout=subprocess.PIPE,
@@ -37,9 +38,7 @@ except:
     return_value = 1
     
 # Test for MPI's mpirun or mpiexec
-if _try_cmd("mpirun --version") or _try_cmd("mpiexec"):
-    return_value = 0
-else:
+if not (_try_cmd("mpirun --version") or _try_cmd("mpiexec")):
     print("mpirun/mpiexec missing")
     return_value = 1
 
@@ -0,0 +1,147 @@
+###############################################################################
+#
+#  Reading the result store of the energy gap scan
+#
+###############################################################################
+#
+#  The energy gap scan of script_Policht2021.py saves its 2D maps into the
+#  subdirectory "store" of the output directory (with the option
+#  result_store: "store"). Every process appends chunks of maps, one file
+#
+#     maps_<component>_<node>_<chunk>.npy
+#
+#  per signal component (p_re, p_nr, m_re, m_nr) holding an array of the
+#  shape (number of maps, N1, N2), and rows of its index file
+#
+#     index_<node>.dat
+#
+#  with the tag, the parameters (dE, J, E0, omega) and the chunk and row of
+#  every map. Runs into the same output directory append new chunks; when
+#  a tag was saved more than once, the newest map is used. The spectrum
+#  template_<component>_<node>.qrp carries the axes and other properties
+#  common to all maps. Single maps are read from the
+#  memory mapped chunk files; LazySpectra creates the spectra only when
+#  they are accessed, so that the memory needed by the post-processing
+#  scripts does not grow with the size of the scan.
+#
+
+import os
+import glob
+
+import numpy
+
+import quantarhei as qr
+
+
+components = ["p_re", "p_nr", "m_re", "m_nr"]
+index_columns = ["tag", "dE", "J", "E0", "omega", "chunk", "row"]
+
+
+def has_store(dname):
+    """Returns True if the directory contains a result store
+
+    """
+    return len(glob.glob(os.path.join(dname, "store", "index_*.dat"))) > 0
+
+
+def load_index(dname):
+    """Returns the list of the stored maps ordered by their tags
+
+    Each map is represented by a dictionary with the items of
+    `index_columns` and the number of the process "node" which saved it.
+    Of the maps saved with the same tag, only the newest one (that of
+    the chunk file saved last, or the last one in the index of the process)
+    is returned.
+
+    """
+    newest = dict()
+    for iname in glob.glob(os.path.join(dname, "store", "index_*.dat")):
+        node = int(os.path.basename(iname)[6:-4])
+        rows = numpy.loadtxt(iname, ndmin=2)
+        for (ir, row) in enumerate(rows):
+            entry = dict(zip(index_columns, row))
+            for key in ["tag", "chunk", "row"]:
+                entry[key] = int(entry[key])
+            entry["node"] = node
+            fname = os.path.join(dname, "store", "maps_"+components[0]+"_"+
+                                 str(node)+"_"+str(entry["chunk"])+".npy")
+            age = (os.path.getmtime(fname), entry["chunk"], ir)
+            tag = entry["tag"]
+            if (tag not in newest) or (age >= newest[tag][0]):
+                newest[tag] = (age, entry)
+
+    return [newest[tag][1] for tag in sorted(newest)]
+
+
+def load_map(dname, comp, entry, mmap=True):
+    """Returns the data of the map `entry` of the signal component `comp`
+
+    With `mmap` True, the data are a view of the memory mapped chunk file.
+
+    """
+    fname = os.path.join(dname, "store", "maps_"+comp+"_"+str(entry["node"])+
+                         "_"+str(entry["chunk"])+".npy")
+    if mmap:
+        return numpy.load(fname, mmap_mode="r")[entry["row"]]
+    return numpy.load(fname)[entry["row"]]
+
+
+def load_template(dname, comp, node):
+    """Returns the template spectrum of the component `comp` of the process
+
+    """
+    return qr.load_parcel(os.path.join(dname, "store", "template_"+comp+"_"+
+                                       str(node)+".qrp"))
+
+
+def get_spectrum(dname, comp, entry, templates=None):
+    """Returns the map `entry` of the component `comp` as a 2D spectrum
+
+    Templates already loaded can be passed in the dictionary `templates`
+    (with the keys (comp, node)), to which newly loaded ones are added.
+
+    """
+    if templates is None:
+        templates = dict()
+    key = (comp, entry["node"])
+    if key not in templates:
+        templates[key] = load_template(dname, comp, entry["node"])
+
+    sp = templates[key].deepcopy()
+    sp.data = numpy.array(load_map(dname, comp, entry))
+    sp.log_params(dict([(par, entry[par])
+                        for par in ["dE", "J", "E0", "omega"]]))
+    return sp
+
+
+class LazySpectra:
+    """Sequence of the stored spectra of the signal component `comp`
+
+    The spectra are ordered by their tags and created from the memory
+    mapped chunk files only when they are accessed, so that scans of any
+    size can be iterated over with bounded memory. With `normalize` True,
+    the spectra are normalized to their maximum absolute value.
+
+    """
+
+    def __init__(self, dname, comp, normalize=False):
+        self.dname = dname
+        self.comp = comp
+        self.normalize = normalize
+        self.entries = load_index(dname)
+        self.tags = [entry["tag"] for entry in self.entries]
+        self.templates = dict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, ii):
+        sp = get_spectrum(self.dname, self.comp, self.entries[ii],
+                          self.templates)
+        if self.normalize:
+            sp.normalize2(dpart=qr.part_ABS)
+        return sp
+
+    def __iter__(self):
+        for ii in range(len(self.entries)):
+            yield self[ii]
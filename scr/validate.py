@@ -1,12 +1,48 @@
 import sys
 import os
 import glob
+import json
+import multiprocessing
 
 import numpy
 
 import quantarhei as qr
 
-scan_for_dir = True
+import result_store
+
+###############################################################################
+#
+#  CONFIGURATION SECTION
+#
+###############################################################################
+
+# Tolerances of the comparison of the calculated maps with the saved ones,
+# per signal component (the tolerances of a component not given for it are
+# taken from "default"):
+#
+#   rtol, atol : element-wise tolerances as in numpy.allclose
+#   rel_l2     : L2 norm of the difference relative to that of the saved map
+#   peak       : shift of the position of the maximum in grid points
+#
+# rel_l2 and peak are not checked if they are None, so that the defaults
+# pass and fail exactly as numpy.allclose does; the error metrics are
+# reported in any case. The tolerances can be changed in
+# script_Policht2021.yaml by the option "validation_tolerances" with
+# the same structure
+tolerances = dict(default=dict(rtol=1.0e-5, atol=1.0e-8, rel_l2=None,
+                               peak=None))
+
+# number of processes comparing the maps (0 means one per core)
+Nworkers = 0
+
+# the report is saved into the validated directory
+report_file = "validation_report.json"
+
+###############################################################################
+#
+#  END OF CONFIGURATION SECTION
+#
+###############################################################################
 
 print("\nVerifying test calculations")
 print("---------------------------")
@@ -19,65 +55,160 @@ smode = INP.simulation_mode
 print("Simulation mode:", smode)
 
 try:
-    if scan_for_dir:
-        list_of_files = glob.glob('./*')
-        list_of_directories = []
-        for fl in list_of_files:
-            if os.path.isdir(fl):
-                list_of_directories.append(fl)
-        target_dir = max(list_of_directories, key=os.path.getctime)
-    else:
-        target_dir = sys.argv[1]
-    
+    input_tolerances = INP.validation_tolerances
 except:
-    print("Simulation output directory not specified")
-    qr.exit()
-    
+    input_tolerances = dict()
+for comp in input_tolerances:
+    if comp not in tolerances:
+        tolerances[comp] = dict()
+    tolerances[comp].update(input_tolerances[comp])
+
+# the directory from the command line or the newest simulation output
+if (len(sys.argv) > 1) and (sys.argv[1] != ""):
+    target_dir = sys.argv[1]
+else:
+    list_of_directories = [fl for fl in glob.glob('./sim_*')
+                           if os.path.isdir(fl)]
+    if len(list_of_directories) == 0:
+        print("Simulation output directory not specified")
+        qr.exit()
+    target_dir = max(list_of_directories, key=os.path.getctime)
 
 print("Target dir:", target_dir)
-OK = True
 
-print("\nTest results:")
+
+def map_errors(saved, calcd, axes):
+    """Returns the error metrics of a calculated map
+    """
+    diff = numpy.abs(calcd - saved)
+    norm = numpy.linalg.norm(saved)
+    mx = numpy.max(numpy.abs(saved))
+
+    isv = numpy.unravel_index(numpy.argmax(numpy.abs(saved)), saved.shape)
+    icl = numpy.unravel_index(numpy.argmax(numpy.abs(calcd)), calcd.shape)
+
+    return dict(max_abs=float(numpy.max(diff)),
+                rel_max=float(numpy.max(diff)/mx) if mx > 0.0 else 0.0,
+                rel_l2=(float(numpy.linalg.norm(calcd - saved)/norm)
+                        if norm > 0.0 else float(numpy.linalg.norm(calcd))),
+                peak_saved=[float(axes[0][isv[0]]), float(axes[1][isv[1]])],
+                peak_calcd=[float(axes[0][icl[0]]), float(axes[1][icl[1]])],
+                peak_shift=int(max(abs(isv[0]-icl[0]), abs(isv[1]-icl[1]))))
+
+
+def compare(job):
+    """Compares one map and returns the entry of the report
+    """
+    (dataf, comp, tag) = job
+    tol = dict(tolerances["default"], **tolerances.get(comp, dict()))
+
+    if tag is None:
+        sp_saved = saved[dataf]
+        data_calcd = qr.load_parcel(os.path.join(target_dir, dataf)).data
+    else:
+        sp_saved = saved[dataf].get_spectrum(tag)
+        if use_store:
+            data_calcd = result_store.load_map(target_dir, comp, entries[tag])
+            # the map has to be stored under the tag of its parameters
+            calcd_dE = entries[tag]["dE"]
+        else:
+            data_calcd = calcd[dataf].get_spectrum(tag).data
+
+    with qr.energy_units("1/cm"):
+        axes = (sp_saved.xaxis.data, sp_saved.yaxis.data)
+    err = map_errors(sp_saved.data, data_calcd, axes)
+    err["allclose"] = bool(numpy.allclose(sp_saved.data, data_calcd,
+                                          rtol=tol["rtol"], atol=tol["atol"]))
+    err["OK"] = err["allclose"]
+    if (tag is not None) and use_store:
+        err["OK"] = err["OK"] and bool(calcd_dE == sp_saved.params["dE"])
+    if tol["rel_l2"] is not None:
+        err["OK"] = err["OK"] and (err["rel_l2"] <= tol["rel_l2"])
+    if tol["peak"] is not None:
+        err["OK"] = err["OK"] and (err["peak_shift"] <= tol["peak"])
+    err.update(file=dataf, component=comp, tag=tag)
+    return err
+
+
+#
+# Maps to compare
+#
+saved = dict()
+calcd = dict()
+jobs = []
+use_store = False
+cmpr_dir = os.path.join("templates","data_test_"+smode)
+try:
+    library = INP.spectral_library["useit"]
+except:
+    library = False
+if smode == "disorder" and library:
+    # averages from the spectral library have their own saved data
+    cmpr_dir = os.path.join("templates","data_test_library")
 
 if smode == "single" or smode == "scan":
     cmpr_data = ["cont_p_re_0.qrp", "cont_p_nr_0.qrp", "cont_m_re_0.qrp", "cont_m_nr_0.qrp"]
-    
-    cmpr_dir = os.path.join("templates","data_test_"+smode)
+
+    # the maps are either in the result store or in the containers
+    use_store = result_store.has_store(target_dir)
+    if use_store:
+        stored = result_store.load_index(target_dir)
+        entries = dict([(ent["tag"], ent) for ent in stored])
+
     for dataf in cmpr_data:
-        
-        pkg_saved = qr.load_parcel(os.path.join(cmpr_dir, dataf))
-        pkg_calcd = qr.load_parcel(os.path.join(target_dir, dataf))
-        
-        for tag in pkg_saved.spectra:
-            sp_saved = pkg_saved.get_spectrum(tag)
-            sp_calcd = pkg_calcd.get_spectrum(tag)
-            if numpy.allclose(sp_saved.data, sp_calcd.data):
-                print(dataf, ": OK")
-            else:
-                print(dataf, "failed: difference outside standard tolerance")
-                OK = False
-                
+        saved[dataf] = qr.load_parcel(os.path.join(cmpr_dir, dataf))
+        if not use_store:
+            calcd[dataf] = qr.load_parcel(os.path.join(target_dir, dataf))
+        for tag in saved[dataf].spectra:
+            jobs.append((dataf, dataf[5:9], tag))
+
 elif smode == "disorder":
     cmpr_data = ["ave_p_re.qrp", "ave_p_nr.qrp", "ave_m_re.qrp", "ave_m_nr.qrp"]
-    
-    cmpr_dir = os.path.join("templates","data_test_"+smode)
+
     for dataf in cmpr_data:
-        
-        pkg_saved = qr.load_parcel(os.path.join(cmpr_dir, dataf))
-        pkg_calcd = qr.load_parcel(os.path.join(target_dir, dataf))
-        sp_saved = pkg_saved
-        sp_calcd = pkg_calcd        
-        if numpy.allclose(sp_saved.data, sp_calcd.data):
-            print(dataf, ": OK")
-        else:
-            print(dataf, "failed: difference outside standard tolerance")
-            OK = False
+        saved[dataf] = qr.load_parcel(os.path.join(cmpr_dir, dataf))
+        jobs.append((dataf, dataf[4:8], None))
+
+#
+# Comparison (in parallel if possible)
+#
+if (len(jobs) > 1) and ("fork" in multiprocessing.get_all_start_methods()):
+    if Nworkers == 0:
+        Nworkers = os.cpu_count()
+    with multiprocessing.get_context("fork").Pool(Nworkers) as pool:
+        report = pool.map(compare, jobs)
+else:
+    report = [compare(job) for job in jobs]
+
+print("\nTest results:")
+OK = True
+if use_store:
+    saved_tags = sorted(saved[cmpr_data[0]].spectra)
+    if [ent["tag"] for ent in stored] != saved_tags:
+        print("Result store holds", len(stored), "maps with tags",
+              [ent["tag"] for ent in stored], "instead of", saved_tags)
+        OK = False
+for err in report:
+    if err["tag"] is None:
+        name = err["file"]
+    else:
+        name = err["file"]+" (tag "+str(err["tag"])+")"
+    if err["OK"]:
+        print(name, ": OK")
+    else:
+        print(name, "failed: rel. L2 error", err["rel_l2"], "; max. abs."+
+              " error", err["max_abs"], "; peak at", err["peak_calcd"],
+              "instead of", err["peak_saved"], "1/cm")
+        OK = False
+
+rname = os.path.join(target_dir, report_file)
+with open(rname, "w") as f:
+    json.dump(dict(mode=smode, target_dir=target_dir, OK=OK,
+                   tolerances=tolerances, maps=report), f, indent=1)
+print("\nReport saved into:", rname)
 
-        
 if OK:
     print("\nValidation completed sucessfully!!!\n")
 else:
     print("\nValidation failed!!!\n")
     sys.exit(-1)
-    
-
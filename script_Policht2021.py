@@ -129,6 +129,9 @@
     because it tells qrhei driver to run in parallel. The option -n specifies
     the number of processes that will simultaneously start on your computer.
 
+    Without MPI, the calculations can be distributed over the cores of your
+    computer by setting "parallel_backend" to "processes" in the input file.
+
     To simplify running the code, we have provided Makefile to be run by the
     "make" utility (on Linux and Mac), and a batch file called make.bat to be
     run on Windows. The Windows version uses Makefile as a configuration file,
@@ -198,9 +201,20 @@ import os
 import shutil
 import gc
 import platform
-
-# Numpy library
+import copy
+import hashlib
+import glob
+import json
+import concurrent.futures
+import multiprocessing
+
+# Numpy and Scipy libraries
 import numpy
+import scipy.linalg
+import scipy.stats
+import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
 
 # Quantarhei imports
 import quantarhei as qr
@@ -294,6 +308,84 @@ def save_spectra(cont, ext="dat", dir=".", stype=qr.signal_TOTL):
         
 
 
+def store_maps(maps, dname, node=0, chunk=0):
+    """Appends 2D maps to the result store of the process `node`
+
+    `maps` is a list of (tag, (sp_p_re, sp_p_nr, sp_m_re, sp_m_nr)). For
+    each signal component, the maps are saved as one chunk (an array of
+    the shape (len(maps), N1, N2)) into the subdirectory "store" of `dname`,
+    and their tags, parameters and locations are appended to the index
+    of the process. `chunk` has to be a number not used before in `dname`
+    (see next_chunk()). See scr/result_store.py for the reader.
+
+    """
+    sdir = os.path.join(dname, "store")
+    os.makedirs(sdir, exist_ok=True)
+    for (k, ext) in enumerate(["p_re", "p_nr", "m_re", "m_nr"]):
+        tname = os.path.join(sdir, "template_"+ext+"_"+str(node)+".qrp")
+        if not os.path.exists(tname):
+            maps[0][1][k].save(tname)
+        fname = os.path.join(sdir, "maps_"+ext+"_"+str(node)+"_"+
+                             str(chunk)+".npy")
+        with open(fname+".tmp", "wb") as f:
+            numpy.save(f, numpy.array([sps[k].data for (tag, sps) in maps]))
+        os.replace(fname+".tmp", fname)
+
+    # index rows are appended only after the maps are in place
+    iname = os.path.join(sdir, "index_"+str(node)+".dat")
+    new = not os.path.exists(iname)
+    with open(iname, "a") as f:
+        if new:
+            f.write("# tag dE J E0 omega chunk row\n")
+        for (row, (tag, sps)) in enumerate(maps):
+            par = sps[0].params
+            f.write("%d %r %r %r %r %d %d\n" % (tag, par["dE"], par["J"],
+                                                 par["E0"], par["omega"],
+                                                 chunk, row))
+
+
+def next_chunk(dname, node=0):
+    """Returns the number of the first chunk not yet saved by the process
+
+    Chunks saved into the result store of `dname` by previous runs (into
+    the same output directory) are kept; the maps of this run are appended
+    after them, and the readers of the store take the newest map of every
+    tag (see store_index()).
+
+    """
+    fnames = glob.glob(os.path.join(dname, "store", "maps_p_re_"+str(node)+
+                                    "_*.npy"))
+    chunks = [int(os.path.basename(fname)[:-4].split("_")[-1])
+              for fname in fnames]
+    if len(chunks) == 0:
+        return 0
+    return max(chunks) + 1
+
+
+def store_index(dname):
+    """Returns the rows of the index of the result store, one per tag
+
+    Each row is a tuple (tag, dE, J, E0, omega, chunk, row, node). When
+    a tag was saved more than once (by runs into the same directory), only
+    its newest row is returned, i.e. the one of the chunk file saved last
+    (or the last one in the index of the process).
+
+    """
+    newest = dict()
+    for iname in glob.glob(os.path.join(dname, "store", "index_*.dat")):
+        node = os.path.basename(iname)[6:-4]
+        for (ir, (tag, dE, J, E0, omega, chunk, row)) in \
+            enumerate(numpy.loadtxt(iname, ndmin=2)):
+            fname = os.path.join(dname, "store", "maps_p_re_"+node+"_"+
+                                 str(int(chunk))+".npy")
+            age = (os.path.getmtime(fname), int(chunk), ir)
+            if (tag not in newest) or (age >= newest[tag][0]):
+                newest[tag] = (age, (int(tag), dE, J, E0, omega, int(chunk),
+                                     int(row), node))
+
+    return [newest[tag][1] for tag in sorted(newest)]
+
+
 def save_averages(cont, dname):
     """Saves disorder averaged spectra
 
@@ -313,6 +405,344 @@ def save_averages(cont, dname):
     cont_m_nr.save(fname)
 
 
+def save_checkpoint(ckpt, dname, node=0):
+    """Saves a checkpoint of the disorder averaging done by a process
+
+    The checkpoint is a dictionary with the sums (not averages) of
+    the spectra, the indices of the realizations included in the sums
+    (in the order in which they were added), the number of realizations
+    of the averaging and the state of the random number generator before
+    the disorder was generated.
+
+    """
+    fname = os.path.join(dname, "checkpoint_"+str(node)+".qrp")
+    # an interrupted write must not destroy the previous checkpoint
+    qr.save_parcel(ckpt, fname+".tmp")
+    os.replace(fname+".tmp", fname)
+
+
+def load_checkpoints(dname):
+    """Loads checkpoints of all processes of a disorder averaging
+
+    Returns a dictionary of the checkpoints with the process ranks as keys.
+
+    """
+    ckpts = dict()
+    for fname in glob.glob(os.path.join(dname, "checkpoint_*.qrp")):
+        node = int(os.path.basename(fname)[len("checkpoint_"):-len(".qrp")])
+        ckpts[node] = qr.load_parcel(fname)
+    return ckpts
+
+
+def gauss_hermite_nodes(Nreal, Nst):
+    """Number of Gauss-Hermite nodes per site for about `Nreal` realizations
+
+    """
+    return max(1, int(numpy.round(Nreal**(1.0/Nst))))
+
+
+def disorder_samples(Nst, Nreal, sigma, sampling="random"):
+    """Returns the disorder in site energies and the weights of realizations
+
+    The disorder is Gaussian with the standard deviation `sigma` on each
+    of the `Nst` sites. The weights are normalized to the mean of one, so
+    that the weighted sum of the spectra divided by `Nreal` is the average.
+    The `sampling` is one of
+
+    "random"          : plain Monte Carlo
+    "antithetic"      : Monte Carlo in pairs of opposite disorder
+    "sobol", "halton" : scrambled quasi-Monte Carlo sequences, `Nreal`
+                        has to be a power of 2 for "sobol"
+    "gauss-hermite"   : tensor-product Gauss-Hermite quadrature, `Nreal`
+                        has to be a power of `Nst`
+
+    Random numbers are taken from numpy.random, so that the samples are
+    reproduced from its state.
+
+    """
+    disM = numpy.zeros((Nst,Nreal))
+    weights = numpy.ones(Nreal)
+
+    if sampling == "random":
+        for ri in range(Nreal):
+            disM[:,ri] = sigma*numpy.random.randn(Nst)
+
+    elif sampling == "antithetic":
+        for ri in range(0, Nreal, 2):
+            disM[:,ri] = sigma*numpy.random.randn(Nst)
+            if ri+1 < Nreal:
+                disM[:,ri+1] = -disM[:,ri]
+
+    elif sampling in ["sobol", "halton"]:
+        seed = numpy.random.randint(2**31)
+        if sampling == "sobol":
+            # the balance properties of the Sobol sequence hold only for
+            # sample sizes which are powers of 2
+            mm = int(round(numpy.log2(Nreal)))
+            if 2**mm != Nreal:
+                raise Exception("Sobol sampling requires N_realizations"+
+                                " = 2**m")
+            engine = scipy.stats.qmc.Sobol(d=Nst, scramble=True, seed=seed)
+            uu = engine.random_base2(mm)
+        else:
+            engine = scipy.stats.qmc.Halton(d=Nst, scramble=True, seed=seed)
+            uu = engine.random(Nreal)
+        disM[:,:] = sigma*scipy.stats.norm.ppf(uu).T
+
+    elif sampling == "gauss-hermite":
+        Nn = gauss_hermite_nodes(Nreal, Nst)
+        if Nn**Nst != Nreal:
+            raise Exception("Gauss-Hermite quadrature requires "+
+                            "N_realizations = n**"+str(Nst))
+        # nodes and weights for the weight function exp(-x**2/2)
+        (xx, ww) = numpy.polynomial.hermite_e.hermegauss(Nn)
+        ww = ww/numpy.sum(ww)
+        xgrid = numpy.meshgrid(*([xx]*Nst), indexing="ij")
+        wgrid = numpy.meshgrid(*([ww]*Nst), indexing="ij")
+        for ii in range(Nst):
+            disM[ii,:] = sigma*xgrid[ii].ravel()
+        weights = Nreal*numpy.prod([wg.ravel() for wg in wgrid], axis=0)
+
+    else:
+        raise Exception("Unknown disorder sampling: "+str(sampling))
+
+    return disM, weights
+
+
+def model_parameters(par, vib_loc):
+    """Returns the input parameters which determine the spectra of a run
+
+    These are all parameters of the model (the vibrational mode `par`
+    on the molecule `vib_loc`, energies, couplings, relaxation and
+    temperature) and of the time axes and the processing of the spectra,
+    except the energy gap. They are saved with the results of every run
+    and compared when the spectra of a scan are used as a spectral
+    library. The values pass through JSON, so that they compare equal
+    to the saved ones.
+
+    """
+    keys = ["E0", "resonance_coupling", "dip1", "dip2", "rate", "trimer",
+            "temperature", "detailed_balance", "t2_N_steps", "t2_time_step",
+            "fine_splitting", "t2_propagation", "t1_N_steps", "t1_time_step",
+            "t3_N_steps", "t3_time_step", "feature_width", "feature_width2",
+            "tukey_window_r", "trim_maps_to", "omega_uncertainty"]
+    mp = dict(vibmode=par, location_of_vibrations=vib_loc)
+    for key in keys:
+        try:
+            mp[key] = getattr(INP, key)
+        except:
+            mp[key] = None
+    if mp["t2_propagation"] is None:
+        mp["t2_propagation"] = "dense"
+
+    return json.loads(json.dumps(mp))
+
+
+def check_spectral_library(ldir, par, vib_loc):
+    """Checks that the scan in `ldir` was calculated with the same model
+
+    The parameters saved by the scan (see model_parameters()) are compared
+    with those of the current run; an exception lists the differing ones.
+
+    """
+    fname = os.path.join(ldir, "model_parameters.json")
+    if not os.path.exists(fname):
+        raise Exception("The energy gap scan in "+str(ldir)+" has no file"+
+                        " model_parameters.json; its parameters cannot be"+
+                        " checked")
+    with open(fname) as f:
+        lmps = json.load(f)
+
+    mp = model_parameters(par, vib_loc)
+    if mp not in lmps:
+        diff = [key for key in mp if lmps[0].get(key) != mp[key]]
+        raise Exception("The energy gap scan in "+str(ldir)+" was"+
+                        " calculated with different parameters: "+
+                        ", ".join(diff))
+
+
+def load_spectral_library(ldir):
+    """Loads the 2D spectra of an energy gap scan from its output directory
+
+    Returns the scanned energy gaps (in ascending order) and the list of
+    the four lists of the corresponding spectra (p_re, p_nr, m_re, m_nr).
+    The spectra are read from the result store (see store_maps()) or from
+    the containers.
+
+    """
+    lib = []
+    for ext in ["p_re", "p_nr", "m_re", "m_nr"]:
+        sps = []
+        tmpls = dict()
+        for (tag, dE, J, E0, omega, chunk, row, node) in store_index(ldir):
+            if node not in tmpls:
+                tmpls[node] = qr.load_parcel(os.path.join(ldir, "store",
+                                             "template_"+ext+"_"+node+".qrp"))
+            sp = tmpls[node].deepcopy()
+            sp.data = numpy.load(os.path.join(ldir, "store", "maps_"+ext+"_"+
+                                              node+"_"+str(chunk)+".npy"),
+                                 mmap_mode="r")[row].copy()
+            sp.log_params(dict(J=J, dE=dE, E0=E0, omega=omega))
+            sps.append(sp)
+        for fname in sorted(glob.glob(os.path.join(ldir,
+                                                   "cont_"+ext+"_*.qrp"))):
+            cont = qr.load_parcel(fname)
+            for tag in cont.spectra:
+                sps.append(cont.get_spectrum(tag))
+        sps.sort(key=lambda sp: sp.params["dE"])
+        lib.append(sps)
+
+    if len(lib[0]) < 2:
+        raise Exception("No energy gap scan found in "+str(ldir))
+    gaps = numpy.array([sp.params["dE"] for sp in lib[0]])
+
+    return gaps, lib
+
+
+def shift_diagonal(data, shifts):
+    """Shifts a 2D map along its diagonal
+
+    `shifts` are the shifts along the first and the second axis in grid
+    points (they differ when the steps of the two frequency axes differ).
+    Values between the grid points are interpolated linearly.
+
+    """
+    sre = scipy.ndimage.shift(numpy.real(data), shifts, order=1,
+                              mode="constant", cval=0.0)
+    if numpy.iscomplexobj(data):
+        sim = scipy.ndimage.shift(numpy.imag(data), shifts, order=1,
+                                  mode="constant", cval=0.0)
+        return sre + 1j*sim
+    return sre
+
+
+def library_average(gaps, sps, dE, sigma, Nnodes=15):
+    """Average of dimer 2D spectra over disorder of the site energies
+
+    The spectra `sps` were calculated for the dimer with site energies E0
+    and E0 + gap for the energy gaps `gaps` (in 1/cm). With the Gaussian
+    disorder d0 and d1 of the site energies (standard deviation `sigma`),
+    the gap is dE + d1 - d0, and the spectrum is shifted by d0 along the
+    diagonal. The distribution of the gap is integrated by the trapezoidal
+    rule over the scanned gaps, and the distribution of the shift for
+    a given gap by Gauss-Hermite quadrature with `Nnodes` nodes.
+
+    """
+    # distribution of the energy gap
+    sg = numpy.sqrt(2.0)*sigma
+    covered = (scipy.stats.norm.cdf(gaps[-1], loc=dE, scale=sg)
+               - scipy.stats.norm.cdf(gaps[0], loc=dE, scale=sg))
+    if covered < 0.99:
+        raise Exception("The energy gap scan from "+str(gaps[0])+" to "+
+                        str(gaps[-1])+" 1/cm does not cover the disorder")
+    dg = numpy.zeros(len(gaps))
+    dg[1:-1] = (gaps[2:]-gaps[:-2])/2.0
+    dg[0] = (gaps[1]-gaps[0])/2.0
+    dg[-1] = (gaps[-1]-gaps[-2])/2.0
+    wg = numpy.exp(-((gaps-dE)**2)/(2.0*sg**2))*dg
+    wg = wg/numpy.sum(wg)
+
+    # distribution of the shift d0 for a given gap has the mean -(gap-dE)/2
+    # and the standard deviation sigma/sqrt(2)
+    (xx, ww) = numpy.polynomial.hermite_e.hermegauss(Nnodes)
+    ww = ww/numpy.sum(ww)
+    # steps of the omega1 and omega3 axes (data are indexed by them)
+    step1 = qr.convert(sps[0].xaxis.step, "int", "1/cm")
+    step3 = qr.convert(sps[0].yaxis.step, "int", "1/cm")
+
+    data = numpy.zeros(sps[0].data.shape, dtype=sps[0].data.dtype)
+    for kk in range(len(gaps)):
+        if wg[kk] < 1.0e-12*numpy.max(wg):
+            continue
+        for jj in range(Nnodes):
+            d0 = -(gaps[kk]-dE)/2.0 + sigma*xx[jj]/numpy.sqrt(2.0)
+            data += wg[kk]*ww[jj]*shift_diagonal(sps[kk].data,
+                                                 (d0/step1, d0/step3))
+
+    av = sps[0].deepcopy()
+    av.data = data
+    return av
+
+
+def welford_update(acc, x):
+    """Adds array `x` to the running mean and variance of a set of arrays
+
+    The accumulator `acc` is a dictionary with the number of arrays "n",
+    their mean "mean" and the sum "M2" of the squared absolute deviations
+    from the mean (Welford's algorithm), or None for an empty set. Returns
+    the updated accumulator.
+
+    """
+    if acc is None:
+        return dict(n=1, mean=x.copy(), M2=numpy.zeros(x.shape))
+
+    n = acc["n"]+1
+    delta = x - acc["mean"]
+    mean = acc["mean"] + delta/n
+    M2 = acc["M2"] + numpy.real(delta*numpy.conj(x - mean))
+
+    return dict(n=n, mean=mean, M2=M2)
+
+
+def welford_combine(acca, accb):
+    """Combines accumulators of two sets of arrays (see welford_update())
+
+    """
+    if acca is None:
+        return accb
+    if accb is None:
+        return acca
+
+    n = acca["n"]+accb["n"]
+    delta = accb["mean"] - acca["mean"]
+    mean = acca["mean"] + delta*(accb["n"]/n)
+    M2 = acca["M2"] + accb["M2"] + (numpy.abs(delta)**2)*(acca["n"]*accb["n"]/n)
+
+    return dict(n=n, mean=mean, M2=M2)
+
+
+def relative_error(acc):
+    """Relative standard error of the mean of the accumulated arrays
+
+    The standard error and the mean are measured by their norms over
+    the whole array.
+
+    """
+    if (acc is None) or (acc["n"] < 2):
+        return numpy.inf
+    se2 = numpy.sum(acc["M2"])/((acc["n"]-1)*acc["n"])
+    return numpy.sqrt(se2/numpy.sum(numpy.abs(acc["mean"])**2))
+
+
+def convergence(accs, config):
+    """Returns the number of realizations and relative errors of the maps
+
+    The accumulators `accs` of all processes are combined.
+
+    """
+    if config.inparallel:
+        allaccs = config.comm.allgather(accs)
+        accs = allaccs[0]
+        for oaccs in allaccs[1:]:
+            accs = [welford_combine(accs[k], oaccs[k])
+                    for k in range(len(accs))]
+
+    nall = 0
+    if accs[0] is not None:
+        nall = accs[0]["n"]
+    return nall, [relative_error(acc) for acc in accs]
+
+
+def save_convergence(history, dname):
+    """Saves the history of the convergence of the disorder averaging
+
+    """
+    fname = os.path.join(dname, "convergence.dat")
+    numpy.savetxt(fname, numpy.array(history),
+                  header="realizations, relative standard errors of maps"+
+                         " p_re, p_nr, m_re, m_nr")
+
+
 def unite_containers(node=0):
     """Collects container parts from the directory to make a single container
 
@@ -335,31 +765,347 @@ def unite_containers(node=0):
     cont_m_nr = cont_m_nr.unitedir(fname4)
     cont_m_nr.save(fname4+".qrp")
 
+
+def eUt_cache_key(eUt, relt, pdeph, method="dense"):
+    """Returns a key identifying the evolution superoperator `eUt`
+
+    The key is a hash of the Hamiltonian, the relaxation (Lindblad)
+    operators including the rates, the pure dephasing, the time steps and
+    the propagation method used in the calculation of `eUt`. The number
+    of t2 steps is not included; superoperators differing only in the
+    length of the t2 axis have the same key (see load_eUt_from_cache()).
+
+    """
+    sha = hashlib.sha256()
+    for arr in [eUt.get_Hamiltonian().data, relt.Km, relt.Lm, relt.Ld,
+                pdeph.data]:
+        sha.update(numpy.ascontiguousarray(arr).tobytes())
+    tms = (pdeph.dtype, eUt.time.start, eUt.time.step,
+           eUt.dense_time.length, eUt.dense_time.step, method)
+    sha.update(str(tms).encode())
+
+    return sha.hexdigest()
+
+
+def load_from_cache(cache, key):
+    """Returns the object stored under `key` in the cache or None
+
+    """
+    fname = os.path.join(cache["dir"], key+".qrp")
+    try:
+        obj = qr.load_parcel(fname)
+        # mark the entry as the most recently used one
+        os.utime(fname)
+    except Exception:
+        # not in the cache (or being written by another process)
+        return None
+
+    return obj
+
+
+def save_to_cache(cache, key, obj):
+    """Saves an object into the cache under `key`
+
+    When the size of the cache exceeds cache["max_size"] (in MB), the least
+    recently used entries are deleted.
+
+    """
+    drnm = cache["dir"]
+    try:
+        os.makedirs(drnm)
+    except FileExistsError:
+        # directory already exists
+        pass
+
+    # write and rename, so that other processes never see partial files
+    fname = os.path.join(drnm, key+".qrp")
+    tname = fname+"."+str(os.getpid())+".tmp"
+    obj.save(tname)
+    os.replace(tname, fname)
+
+    entries = []
+    for flnm in glob.glob(os.path.join(drnm, "*.qrp")):
+        try:
+            entries.append((os.path.getmtime(flnm), os.path.getsize(flnm),
+                            flnm))
+        except FileNotFoundError:
+            # deleted by another process
+            pass
+    entries.sort()
+
+    total = sum([ent[1] for ent in entries])
+    max_size = cache["max_size"]*1024*1024
+    # the newest entry is always kept
+    while (total > max_size) and (len(entries) > 1):
+        (mtime, size, flnm) = entries.pop(0)
+        try:
+            os.remove(flnm)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def extend_eUt(eUt, time):
+    """Extends evolution superoperator `eUt` to a longer time axis `time`
+
+    Only the missing t2 steps are propagated, starting from the last known
+    one, in the same way as in EvolutionSuperOperator.calculate() with
+    time-independent relaxation and dephasing.
+
+    """
+    Nold = eUt.time.length
+    data = numpy.zeros((time.length,)+eUt.data.shape[1:], dtype=qr.COMPLEX)
+    data[:Nold,:,:,:,:] = eUt.data
+    Udt = data[1,:,:,:,:]
+    for ti in range(Nold, time.length):
+        data[ti,:,:,:,:] = numpy.tensordot(Udt, data[ti-1,:,:,:,:])
+
+    eUt.data = data
+    eUt.time = time
+
+
+def load_eUt_from_cache(cache, key, time):
+    """Returns evolution superoperator on the time axis `time` or None
+
+    The evolution superoperators are stored in the cache under their key
+    (see eUt_cache_key()) and the number of t2 steps. When there is no
+    entry with the length of `time`, a longer entry is truncated, or
+    a shorter one is extended by the missing t2 steps (and saved).
+
+    """
+    Nt = time.length
+    eUt = load_from_cache(cache, key+"_"+str(Nt))
+    if eUt is not None:
+        return eUt
+
+    lengths = []
+    for flnm in glob.glob(os.path.join(cache["dir"], key+"_*.qrp")):
+        lengths.append(int(os.path.basename(flnm)[len(key)+1:-4]))
+    longer = [nn for nn in lengths if nn > Nt]
+    shorter = [nn for nn in lengths if (nn < Nt) and (nn > 1)]
+
+    if len(longer) > 0:
+        eUt = load_from_cache(cache, key+"_"+str(min(longer)))
+        if eUt is not None:
+            eUt.data = eUt.data[:Nt,:,:,:,:].copy()
+            eUt.time = time
+    elif len(shorter) > 0:
+        eUt = load_from_cache(cache, key+"_"+str(max(shorter)))
+        if eUt is not None:
+            print("Extending evolution superoperator from",
+                  eUt.time.length, "to", Nt, "t2 steps")
+            extend_eUt(eUt, time)
+            save_to_cache(cache, key+"_"+str(Nt), eUt)
+
+    return eUt
+
+
+def new_profile():
+    """Returns an empty profile of the stages of the calculations
+
+    """
+    return dict(stages=dict(), t2_time=numpy.zeros(0),
+                t2_count=numpy.zeros(0, dtype=int))
+
+
+def peak_memory():
+    """Returns the peak resident memory of this process in MB
+
+    Zero is returned where the resource module is not available (Windows).
+
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == "Darwin":
+        return mem/2.0**20
+    return mem/2.0**10
+
+
+def stage_mark():
+    """Returns the mark (time and peak memory) at the start of a stage
+
+    """
+    if not instrumentation:
+        return None
+    return (time.perf_counter(), peak_memory())
+
+
+def stage_done(name, mark, **counts):
+    """Adds the time and the growth of the peak memory since `mark` to a stage
+
+    The keyword arguments are counts (e.g. of pathways or of MB of
+    allocated arrays) added to those of the stage `name`. Returns the mark
+    from which the next stage is measured. Nothing is recorded without
+    the option "instrumentation".
+
+    """
+    if not instrumentation:
+        return None
+    now = stage_mark()
+    if name not in profile["stages"]:
+        profile["stages"][name] = dict(calls=0, time=0.0, memory_MB=0.0)
+    stage = profile["stages"][name]
+    stage["calls"] += 1
+    stage["time"] += now[0] - mark[0]
+    stage["memory_MB"] += now[1] - mark[1]
+    for key in counts:
+        stage[key] = stage.get(key, 0) + counts[key]
+    return now
+
+
+def propagation_MB(eUt, prop=None):
+    """Returns the size in MB of the arrays held to propagate `eUt`
+
+    These are the data of `eUt` (at all t2 times in the mode "all", at one
+    t2 time in the mode "jit") and the arrays of the propagator `prop`
+    (see diagonalize_liouvillian() and batch_propagators()).
+
+    """
+    nbytes = eUt.data.nbytes
+    if prop is not None:
+        nbytes += sum([arr.nbytes for arr in prop.values()])
+    return nbytes/2.0**20
+
+
+def t2_steps_done(stamps):
+    """Adds the times between the consecutive `stamps` to the t2 steps
+
+    """
+    if (not instrumentation) or (len(stamps) < 2):
+        return
+    dt = numpy.diff(stamps)
+    grow = len(dt) - len(profile["t2_time"])
+    if grow > 0:
+        profile["t2_time"] = numpy.append(profile["t2_time"],
+                                          numpy.zeros(grow))
+        profile["t2_count"] = numpy.append(profile["t2_count"],
+                                           numpy.zeros(grow, dtype=int))
+    profile["t2_time"][:len(dt)] += dt
+    profile["t2_count"][:len(dt)] += 1
+
+
+def take_profile():
+    """Returns the profile collected by this process and starts a new one
+
+    """
+    global profile
+    prof = profile
+    profile = new_profile()
+    return prof
+
+
+def merge_profiles(prof, other):
+    """Adds the profile `other` to the profile `prof`
+
+    """
+    for name in other["stages"]:
+        if name not in prof["stages"]:
+            prof["stages"][name] = dict()
+        stage = prof["stages"][name]
+        for key in other["stages"][name]:
+            stage[key] = stage.get(key, 0) + other["stages"][name][key]
+    for key in ["t2_time", "t2_count"]:
+        (aa, bb) = (prof[key], other[key])
+        if len(aa) < len(bb):
+            (aa, bb) = (bb, aa)
+        aa = aa.copy()
+        aa[:len(bb)] += bb
+        prof[key] = aa
+
+
+def save_profile(profiles, dname, config):
+    """Reports the profiles of the stages and saves them into `dname`
+
+    `profiles` is a dictionary of the profiles collected by the processes
+    (rank, pid) of this MPI process. Under MPI, they are collected from all
+    processes. The stages are summed over the processes, with the largest
+    time and the largest growth of the peak memory of a single process
+    reported too, and saved together with the times of the t2 steps and
+    the profiles of the processes into stage_profile.json.
+
+    """
+    if config.inparallel:
+        allprof = config.comm.gather(profiles, root=0)
+        if config.rank != 0:
+            return
+        profiles = dict([(proc, prof) for prfs in allprof
+                         for (proc, prof) in prfs.items()])
+
+    total = new_profile()
+    stages = dict()
+    for prof in profiles.values():
+        merge_profiles(total, prof)
+        for name in prof["stages"]:
+            stage = prof["stages"][name]
+            if name not in stages:
+                stages[name] = dict(time_max=0.0, memory_MB_max=0.0)
+            stages[name]["time_max"] = max(stages[name]["time_max"],
+                                           stage["time"])
+            stages[name]["memory_MB_max"] = max(stages[name]["memory_MB_max"],
+                                                stage["memory_MB"])
+    for name in stages:
+        stages[name].update(total["stages"][name])
+    if len(stages) == 0:
+        return
+
+    print("\nStages of the calculations (summed over", len(profiles),
+          "processes):")
+    print("   %-18s %6s %12s %12s %12s" % ("stage", "calls", "time [s]",
+          "max. [s]", "memory [MB]"))
+    for name in stages:
+        print("   %-18s %6d %12.4f %12.4f %12.2f" % (name,
+              stages[name]["calls"], stages[name]["time"],
+              stages[name]["time_max"], stages[name]["memory_MB_max"]))
+    print("   (max.: longest time of one process; memory: largest growth"+
+          " of its peak memory)")
+    nt2 = numpy.maximum(total["t2_count"], 1)
+    print("   mean time of a t2 step:", numpy.sum(total["t2_time"])/
+          max(numpy.sum(total["t2_count"]), 1), "sec")
+
+    fname = os.path.join(dname, "stage_profile.json")
+    with open(fname, "w") as f:
+        json.dump(dict(processes=len(profiles), stages=stages,
+                       t2_steps=dict(time=total["t2_time"].tolist(),
+                                     count=total["t2_count"].tolist(),
+                                     mean=(total["t2_time"]/nt2).tolist()),
+                       per_process=dict([(str(proc), prof["stages"])
+                                         for (proc, prof) in
+                                         profiles.items()])),
+                  f, indent=1)
+    print("Profile saved into:", fname)
+
+
 #
-################################################################################
-################################################################################
+# Profile of the stages of the calculations done by this process (with
+# the option "instrumentation"; see stage_done() and t2_steps_done())
 #
-#  Main simulation routine
+try:
+    instrumentation = INP.instrumentation
+except:
+    instrumentation = False
+profile = new_profile()
+
+
 #
-################################################################################
-################################################################################
+# Built aggregates reused by run() for different site energies
 #
-def run(omega, HR, dE, JJ, rate, E0, vib_loc="up", use_vib=True,
-        detailed_balance=False, temperature=77.0, stype=qr.signal_REPH,
-        save_eUt=False, t2_save_pathways=[], dname=None, trimer=None,
-        disE=None):
-    """Runs a complete set of simulations for a single set of parameters
+aggregate_templates = dict()
 
 
-    If disE is not None it tries to run averaging over Gaussian energetic
-    disorder.
+def build_aggregates(omega, HR, JJ, energies, vib_loc, use_vib, trimer,
+                     J2=None):
+    """Builds the model aggregates with the given site energies (in 1/cm)
 
-    """
-    if dname is None:
-        dname = "sim_"+vib_loc
+    Returns the aggregate with vibrations built with single excitons,
+    its electronic only version and the aggregate with vibrations built
+    with two-exciton states.
 
-    use_trimer =  trimer["useit"]
-    rate_sp = trimer["rate"]
+    """
+    use_trimer = trimer["useit"]
+    mark = stage_mark()
 
     #
     #  PARAMETERS FROM INPUT FILE
@@ -369,66 +1115,15 @@ def run(omega, HR, dE, JJ, rate, E0, vib_loc="up", use_vib=True,
     width = INP.feature_width # 100.0
     width2 = INP.feature_width2
 
-    normalize_maps_to_maximu = False
-    trim_maps = False
-
-    units = "1/cm"
-    with qr.energy_units(units):
-
-        data_descr = "_dO="+str(dE)+"_omega="+str(omega)+ \
-                     "_HR="+str(HR)+"_J="+str(JJ)
-
-        if use_vib:
-            sys_char = "_vib"
-        else:
-            sys_char = "_ele"
-        data_ext = sys_char+".png"
-        obj_ext = sys_char+".qrp"
-
-    # parameters of the SP
-    if use_trimer:
-        E2 = trimer["E2"]
-        epsa = (E0+E2)/2.0
-        DE = trimer["DE"]
-        J2 = 0.5*numpy.sqrt(((E0-E2)**2)-(DE**2))
-        ESP2 = epsa + DE/2.0
-        ESP1 = epsa - DE/2.0
-
     #
-    #   Model system is a dimer of molecules
+    #   Model system is a dimer (or trimer) of molecules
     #
     with qr.energy_units("1/cm"):
 
-        if not use_trimer:
-            
-            if disE is not None:
-                mol1 = qr.Molecule([0.0, E0+disE[0]])
-                mol2 = qr.Molecule([0.0, E0+dE+disE[1]])
-                print("Monomer 1 energy:", E0+disE[0], "1/cm")
-                print("Monomer 2 energy:", E0+dE+disE[1], "1/cm")
-            else:
-                mol1 = qr.Molecule([0.0, E0])
-                mol2 = qr.Molecule([0.0, E0+dE])
-                print("Monomer 1 energy:", E0, "1/cm")
-                print("Monomer 2 energy:", E0+dE, "1/cm")
-        else:
-
-            if disE is not None:
-                mol1 = qr.Molecule([0.0, ESP2+disE[0]])
-                mol2 = qr.Molecule([0.0, E0+dE+disE[1]])
-                print("Monomer 1 (SP_high) energy:", ESP2+disE[0], "1/cm")
-                print("Monomer 2 (B) energy:", E0+dE+disE[1], "1/cm")
-            else:
-                mol1 = qr.Molecule([0.0, ESP2])
-                mol2 = qr.Molecule([0.0, E0+dE])
-                print("Monomer 1 (SP_high) energy:", ESP2, "1/cm")
-                print("Monomer 2 (B) energy:", E0+dE, "1/cm")
-            if disE is not None:
-                mol3 = qr.Molecule([0.0, ESP1+disE[2]])
-                print("Monomer 3 (SP_low) energy:", ESP1+disE[2], "1/cm")
-            else:
-                mol3 = qr.Molecule([0.0, ESP1])
-                print("Monomer 3 (SP_low) energy:", ESP1, "1/cm")
+        mol1 = qr.Molecule([0.0, energies[0]])
+        mol2 = qr.Molecule([0.0, energies[1]])
+        if use_trimer:
+            mol3 = qr.Molecule([0.0, energies[2]])
             mol3.set_transition_width((0,1), width2)
             mol3.set_dipole(0,1, trimer["dipsp"])
 
@@ -466,43 +1161,611 @@ def run(omega, HR, dE, JJ, rate, E0, vib_loc="up", use_vib=True,
     #
     if use_vib:
 
-        with qr.energy_units("1/cm"):
-            mod1 = qr.Mode(omega)
-            mod2 = qr.Mode(omega)
+        with qr.energy_units("1/cm"):
+            mod1 = qr.Mode(omega)
+            mod2 = qr.Mode(omega)
+
+        if vib_loc == "down":
+            set_vib = [True, False]
+        elif vib_loc == "up":
+            set_vib = [False, True]
+        elif vib_loc == "both":
+            set_vib = [True, True]
+        else:
+            raise Exception("Unknown location of the vibrations")
+
+        if set_vib[0]:
+            print("Vibrations set for SP_high molecule")
+            mol1.add_Mode(mod1)
+            mod1.set_nmax(0, INP.vibmode["no_g_vib"])
+            mod1.set_nmax(1, INP.vibmode["no_e_vib"])
+            mod1.set_HR(1, HR)
+
+        if set_vib[1]:
+            print("Vibrations set for B molecule")
+            mol2.add_Mode(mod2)
+            mod2.set_nmax(0, INP.vibmode["no_g_vib"])
+            mod2.set_nmax(1, INP.vibmode["no_e_vib"])
+            mod2.set_HR(1, HR)
+
+    #
+    # Before we build the aggregate, we make its copy to have an unbuilt version
+    #
+    agg3 = agg.deepcopy()
+
+    #
+    # here we build the complete aggregate, its electronic only version
+    # and the aggregate with all states (including 2-EX band)
+    #
+    agg.build(mult=1)
+    agg_el.build(mult=1)
+    mark = stage_done("aggregates", mark)
+    agg3.build(mult=2)
+    stage_done("agg3_build", mark)
+
+    return agg, agg_el, agg3
+
+
+def shift_site_energies(agg, shifts):
+    """Shifts site energies of a built aggregate in place
+
+    `shifts` (in 1/cm) are added to the excitation energies of
+    the molecules. Of all the properties of the built aggregate, only its
+    Hamiltonian depends on the site energies; its diagonal is shifted
+    and the Hamiltonian object is recreated as in Aggregate.build().
+
+    """
+    shifts = [qr.convert(sh, "1/cm", "int") for sh in shifts]
+    for k in range(len(shifts)):
+        agg.monomers[k].elenergies[1] += shifts[k]
+
+    dd = numpy.zeros(agg.Ntot, dtype=numpy.float64)
+    for (a, st) in agg.all_states:
+        elsig = st.elstate.elsignature
+        for k in range(len(shifts)):
+            if elsig[k] == 1:
+                dd[a] += shifts[k]
+
+    rwa_indices = agg.HamOp.rwa_indices
+    agg.HH = agg.HH + numpy.diag(dd)
+    with qr.energy_units("int"):
+        agg.HamOp = qr.Hamiltonian(data=agg.HH)
+    agg.HamOp.set_rwa(rwa_indices)
+
+
+#
+# omega2 maps returned by run(); each map is specified by the omega2 window
+# of the pathways ("p" or "m"), signal type and the sign of omega2 at which
+# the map is taken
+#
+default_maps = [("p", qr.signal_REPH, 1), ("p", qr.signal_NONR, 1),
+                ("m", qr.signal_REPH, -1), ("m", qr.signal_NONR, -1)]
+
+
+def liouvillian(eUt, dephasing=True):
+    """Returns the time-independent Liouvillian of `eUt` as a matrix
+
+    The Liouvillian includes the Hamiltonian (in the RWA, if it is set),
+    the relaxation in the form of Lindblad operators and, if `dephasing`
+    is True, Lorentzian pure dephasing, with the same conventions as
+    ReducedDensityMatrixPropagator. It acts on density matrices flattened
+    in the C order, i.e. like the data of EvolutionSuperOperator at one
+    time reshaped to (N^2, N^2).
+
+    """
+    if (eUt.pdeph is not None) and (eUt.pdeph.dtype != "Lorentzian"):
+        raise Exception("Only Lorentzian dephasing gives time-independent"+
+                        " Liouvillian")
+
+    H = eUt.get_Hamiltonian()
+    if H.has_rwa:
+        HH = H.get_RWA_data()
+    else:
+        HH = H.data
+    one = numpy.eye(HH.shape[0])
+
+    # vec(A rho B) = kron(A, B^T) vec(rho)
+    LL = -1j*(numpy.kron(HH, one) - numpy.kron(one, HH.T))
+    relt = eUt.relt
+    if relt is not None:
+        for mm in range(relt.Km.shape[0]):
+            Km = relt.Km[mm,:,:]
+            Lm = relt.Lm[mm,:,:]
+            Ld = relt.Ld[mm,:,:]
+            LL += (numpy.kron(Km, Ld.T) + numpy.kron(Lm, Km)
+                   - numpy.kron(numpy.dot(Km.T, Lm), one)
+                   - numpy.kron(one, numpy.dot(Ld, Km).T))
+    if dephasing and (eUt.pdeph is not None):
+        LL -= numpy.diag(eUt.pdeph.data.ravel())
+
+    return LL
+
+
+def diagonalize_liouvillian(eUt, ctol=1.0e8):
+    """Prepares propagation of `eUt` by diagonalization of its Liouvillian
+
+    The Liouvillian is diagonalized once and the evolution superoperator
+    at any time is obtained by exponentiating its eigenvalues (see
+    liouvillian_evolution()). If the Liouvillian is defective (condition
+    number of its eigenvectors larger than `ctol`), its exponential over
+    one t2 step is returned instead, and it is applied repeatedly.
+
+    """
+    return batch_propagators([eUt], "diagonalization", ctol)[0]
+
+
+def liouvillian_evolution(prop, time):
+    """Yields evolution superoperator data at all times of `time`
+
+    `prop` is the output of diagonalize_liouvillian(). The data are in
+    the basis in which the Liouvillian was constructed.
+
+    """
+    if "val" in prop:
+        dim = int(round(numpy.sqrt(len(prop["val"]))))
+        for t2 in time.data:
+            Ut = numpy.dot(prop["vec"]*numpy.exp(prop["val"]*t2), prop["inv"])
+            yield Ut.reshape((dim,)*4)
+    else:
+        dim = int(round(numpy.sqrt(prop["step"].shape[0])))
+        Ut = numpy.eye(dim*dim, dtype=qr.COMPLEX)
+        for n2 in range(time.length):
+            if n2 > 0:
+                Ut = numpy.dot(prop["step"], Ut)
+            yield Ut.reshape((dim,)*4)
+
+
+def batch_propagators(eUts, method="dense", ctol=1.0e8):
+    """Prepares propagation of a batch of evolution superoperators
+
+    The evolution superoperators (e.g. of different disorder realizations)
+    have to share the time axis and the dimension. Their Liouvillians
+    are stacked into one array and processed together. With `method`
+    "diagonalization", they are diagonalized as in
+    diagonalize_liouvillian(). With "dense", the propagator over one t2
+    step is composed of the steps over the dense time step, each of them
+    being the fourth order short exponential expansion of the Liouvillian
+    followed by the Lorentzian pure dephasing, exactly as in
+    EvolutionSuperOperator.calculate(). Returns a list of the propagators
+    for liouvillian_evolution().
+
+    """
+    dephasing = (method == "diagonalization")
+    LL = numpy.array([liouvillian(eUt, dephasing) for eUt in eUts])
+    Nb = LL.shape[0]
+
+    if method == "diagonalization":
+        (val, vec) = numpy.linalg.eig(LL)
+        cond = numpy.linalg.cond(vec)
+        props = []
+        for kk in range(Nb):
+            if cond[kk] < ctol:
+                props.append(dict(val=val[kk], vec=vec[kk],
+                                  inv=numpy.linalg.inv(vec[kk])))
+            else:
+                print("Liouvillian is defective; using its matrix"+
+                      " exponential")
+                step = scipy.linalg.expm(LL[kk]*eUts[kk].time.step)
+                props.append(dict(step=step))
+        return props
+
+    elif method != "dense":
+        raise Exception("Unknown propagation method: "+str(method))
+
+    dt = eUts[0].dense_time.step
+    Nd = eUts[0].dense_time.length-1
+    one = numpy.eye(LL.shape[1], dtype=qr.COMPLEX)
+
+    # short exponential expansion
+    step = numpy.array([one for kk in range(Nb)])
+    term = step.copy()
+    for ll in range(1, 5):
+        term = numpy.matmul(LL, term)*(dt/ll)
+        step += term
+
+    # pure dephasing after each step
+    for kk in range(Nb):
+        if eUts[kk].pdeph is not None:
+            expo = numpy.exp(-eUts[kk].pdeph.data*dt).ravel()
+            step[kk,:,:] *= expo[:,numpy.newaxis]
+
+    Udt = step.copy()
+    for ti in range(1, Nd):
+        Udt = numpy.matmul(step, Udt)
+
+    return [dict(step=Udt[kk]) for kk in range(Nb)]
+
+
+def evolution_data(eUt, prop=None):
+    """Yields data of the evolution superoperator at all its t2 times
+
+    The data are in the eigenbasis of the Hamiltonian of `eUt`. For
+    the "jit" mode of EvolutionSuperOperator, the superoperator is
+    propagated here, so that only one t2 time is held in memory. It is
+    propagated by EvolutionSuperOperator.calculate_next(), or, when `prop`
+    (see diagonalize_liouvillian()) is given, by liouvillian_evolution().
+
+    """
+    H = eUt.get_Hamiltonian()
+    dim = eUt.dim
+    if prop is not None:
+        steps = liouvillian_evolution(prop, eUt.time)
+    elif eUt.mode == "jit":
+        eUt.now = 0
+    for n2 in range(eUt.time.length):
+        if prop is not None:
+            Ut = qr.qm.SuperOperator(data=next(steps))
+        elif eUt.mode != "jit":
+            Ut = eUt.at(eUt.time.data[n2])
+        elif n2 == 0:
+            # unity superoperator is the same in all bases
+            yield numpy.eye(dim*dim, dtype=qr.COMPLEX).reshape((dim,)*4)
+            continue
+        else:
+            eUt.calculate_next()
+            Ut = qr.qm.SuperOperator(data=eUt.data.copy())
+        with qr.eigenbasis_of(H):
+            evd = Ut.data.copy()
+        yield evd
+
+
+def evolution_mask(eUt, prop=None, etol=1.0e-6):
+    """Returns a superset of the elements of `eUt` which are ever above `etol`
+
+    The evolution superoperator over n t2 steps is the n-th power of that
+    over one step, U(dt), so that its element connecting two elements of
+    the density matrix can be nonzero only if they are connected by
+    a chain of nonzero elements of U(dt). The mask is the reachability in
+    the graph of the elements of U(dt) larger than etol/(10 Nt), where Nt
+    is the number of t2 steps (smaller elements cannot build up to `etol`
+    over the t2 axis), so that only one t2 step has to be propagated.
+    Pathways of elements which are in the superset, but never above
+    `etol`, have zero evolution factors (see evolution_factors()).
+
+    """
+    steps = evolution_data(eUt, prop)
+    mask = (numpy.abs(next(steps)) > etol)
+    if eUt.time.length > 1:
+        evd = next(steps)
+        Nl = eUt.dim**2
+        links = (numpy.abs(evd) > etol/(10.0*eUt.time.length))
+        dist = scipy.sparse.csgraph.shortest_path(
+                   scipy.sparse.csr_matrix(links.reshape((Nl, Nl))),
+                   unweighted=True)
+        mask = numpy.isfinite(dist).reshape(mask.shape)
+    steps.close()
+
+    return mask
+
+
+def generate_pathways(agg, eUt, lab, dtol=1.0e-12, etol=1.0e-6, prop=None):
+    """Generates Liouville pathways valid for all t2 times of `eUt`
+
+    The pathway topology does not depend on t2. We generate the pathways
+    only once (with unit evolution factors); the factors at individual
+    t2 times are obtained by evolution_factors(). For `prop` see
+    evolution_data(). When the evolution superoperator is propagated
+    during the calculation of the maps ("jit" mode or `prop`), the
+    pathways are generated from the superset of its elements given by
+    evolution_mask(), so that it is not propagated twice.
+
+    """
+    H = eUt.get_Hamiltonian()
+    agg.get_DensityMatrix(condition_type="thermal", temperature=0.0)
+
+    # superoperator marking elements which are ever larger than `etol`
+    if (prop is not None) or (eUt.mode == "jit"):
+        mask = evolution_mask(eUt, prop, etol)
+    else:
+        mask = numpy.zeros((eUt.dim,)*4, dtype=bool)
+        for evd in evolution_data(eUt, prop):
+            mask |= (numpy.abs(evd) > etol)
+    with qr.eigenbasis_of(H):
+        Umask = qr.qm.SuperOperator(data=mask.astype(qr.COMPLEX))
+
+    # if the Hamiltonian is larger than eUt, we will calculate ESA
+    if agg.get_Hamiltonian().dim == eUt.dim:
+        ptype = ("R1g", "R2g", "R3g", "R4g")
+    else:
+        ptype = ("R1g", "R2g", "R3g", "R4g", "R1f*", "R2f*")
+
+    pws = agg.liouville_pathways_3T(ptype=ptype, eUt=Umask, ham=H, t2=0.0,
+                                    lab=lab, dtol=dtol, etol=etol)
+
+    for pw in pws:
+        pw.set_evolution_factor(1.0)
+        pw.orientational_averaging(lab)
+
+    return pws
+
+
+def pathway_elements(pws):
+    """Returns elements of the evolution superoperator used by pathways
+
+    The indices of the elements are returned as a (4, Npws) array together
+    with a mask of the pathways with energy transfer.
+
+    """
+    idx = numpy.zeros((4, len(pws)), dtype=int)
+    rel = numpy.zeros(len(pws), dtype=bool)
+    for kk in range(len(pws)):
+        pw = pws[kk]
+        if pw.relax_order > 0:
+            # pathways with energy transfer
+            (fin, sta) = pw.relaxations[0]
+            idx[:,kk] = [fin[0], fin[1], sta[0], sta[1]]
+            rel[kk] = True
+        else:
+            # ground state pathways
+            i1g = pw.transitions[0,1]
+            i3g = pw.transitions[1,0]
+            idx[:,kk] = [i1g, i3g, i1g, i3g]
+
+    return idx, rel
+
+
+def evolution_factors(elems, evd, etol=1.0e-6):
+    """Returns evolution factors of the pathways
+
+    `evd` are data of the evolution superoperator in the eigenbasis
+    (see evolution_data()), `elems` are the output of pathway_elements().
+    The factors are set to zero where Quantarhei would drop the pathway
+    as too weak.
+
+    """
+    (idx, rel) = elems
+    evf = evd[..., idx[0], idx[1], idx[2], idx[3]]
+    evf[(numpy.abs(evf) <= etol) & rel] = 0.0
+
+    return evf
+
+
+def select_pathways(msc, pws, windows):
+    """Selects pathways into omega2 windows and groups them by lineshape
+
+    All windows (e.g. the positive and the negative omega2 window) are
+    filled in a single pass through the pathways. Pathways with the same
+    line shape differ only by their prefactors, so that the 2D line shape
+    has to be calculated only once for each group. The returned dictionary
+    contains the shapes, their signal types, the windows they belong to and
+    the matrix `coef` which converts evolution factors of all pathways into
+    the weights of the shapes.
+
+    """
+    Nw = len(windows)
+    indices = [[] for iw in range(Nw)]
+    groups = dict()
+    for kk in range(len(pws)):
+        pw = pws[kk]
+        # the same rule as in LiouvillePathwayAnalyzer.select_omega2
+        om2 = pw.get_interval_frequency(len(pw.frequency)-3)
+        noe = 1+pw.order+pw.relax_order
+        for iw in range(Nw):
+            if (om2 >= windows[iw][0]) and (om2 <= windows[iw][1]):
+                indices[iw].append(kk)
+                key = (iw, pw.pathway_type, pw.frequency[0],
+                       pw.frequency[noe-2], tuple(pw.widths), tuple(pw.dephs))
+                if key not in groups:
+                    groups[key] = [pw, []]
+                groups[key][1].append(kk)
+
+    N1 = msc.oa1.length
+    N3 = msc.oa3.length
+    shapes = numpy.zeros((len(groups), N1, N3), dtype=qr.COMPLEX)
+    is_reph = numpy.zeros(len(groups), dtype=bool)
+    window = numpy.zeros(len(groups), dtype=int)
+    coef = numpy.zeros((len(groups), len(pws)), dtype=qr.REAL)
+    ig = 0
+    for key in groups:
+        (pw, members) = groups[key]
+        pref = pw.pref
+        pw.pref = 1.0
+        shapes[ig,:,:] = msc.calculate_pathway(pw, shape=msc.shape)
+        pw.pref = pref
+        is_reph[ig] = (pw.pathway_type == "R")
+        window[ig] = key[0]
+        for kk in members:
+            coef[ig,kk] = pws[kk].pref
+        ig += 1
+
+    return dict(indices=indices, shapes=shapes, is_reph=is_reph,
+                window=window, coef=coef)
+
+
+def calculate_response_cube(psel, wgt, iw, dtype):
+    """Returns 2D responses of an omega2 window at all t2 times
+
+    The responses of the signal type `dtype` (qr.signal_REPH,
+    qr.signal_NONR or qr.signal_TOTL) in the window with index `iw` are
+    returned as one (Nt2, N1, N3) array. `wgt` are the weights of the line
+    shapes at all t2 times, see pathway_weights().
+
+    """
+    sel = (psel["window"] == iw)
+    if dtype == qr.signal_REPH:
+        sel = sel & psel["is_reph"]
+    elif dtype == qr.signal_NONR:
+        sel = sel & ~psel["is_reph"]
+    elif dtype != qr.signal_TOTL:
+        raise Exception("Unknown signal type: "+str(dtype))
+
+    return numpy.tensordot(wgt[:,sel], psel["shapes"][sel], axes=(1,0))
+
+
+def pathway_weights(psel, evf):
+    """Returns weights of the line shapes of all windows at all t2 times
+
+    """
+    return numpy.dot(evf, psel["coef"].T)
+
+
+def omega2_axis(time2):
+    """Returns the omega2 axis of the Fourier transform in t2
+
+    """
+    taxis = qr.TimeAxis(0.0, time2.length, time2.step, atype="complete")
+    return taxis.get_FrequencyAxis()
+
+
+def fft_cube(cube, time2, window):
+    """Fourier transform of 2D responses in t2 with a window function
+
+    This is the transform of TwoDResponseContainer.fft() applied directly
+    to a (Nt2, N1, N3) array of responses. Returns the transformed array
+    and the corresponding omega2 values.
+
+    """
+    Nt = time2.length
+    faxis = omega2_axis(time2)
+
+    Nwin = len(window.data)
+    ftdata = cube*window.data[Nwin-Nt:Nwin,numpy.newaxis,numpy.newaxis]
+    ftdata = numpy.fft.ifft(ftdata, axis=0)
+    ftdata = numpy.fft.fftshift(ftdata, axes=0)
+
+    return ftdata, faxis.data
+
+
+def projection_matrix(time2, window, vals):
+    """Windowed Fourier transform in t2 at selected omega2 values
+
+    Returns the rows of the windowed transform of fft_cube() at the points
+    of the omega2 axis nearest to `vals` (in 1/cm) as a (Nvals, Nt2)
+    matrix, together with the omega2 values of these points. Applied
+    to the line shape weights (see pathway_weights()), it gives weights
+    from which calculate_response_cube() calculates the 2D spectra at
+    these points directly, with O(Nt2) operations per point and line shape.
+
+    """
+    Nt = time2.length
+    faxis = omega2_axis(time2)
+
+    # indices of the nearest omega2 points in the fftshift-ed ordering
+    nvals = qr.convert(numpy.array(vals, dtype=float), "1/cm", "int")
+    imins = numpy.argmin(numpy.abs(faxis.data[numpy.newaxis,:]
+                                   - nvals[:,numpy.newaxis]), axis=1)
+
+    # rows of the inverse DFT matrix (with the window) at these points
+    kk = imins - Nt//2
+    nn = numpy.arange(Nt)
+    Nwin = len(window.data)
+    ftmat = numpy.exp(2.0j*numpy.pi*numpy.outer(kk, nn)/Nt)
+    ftmat *= window.data[numpy.newaxis,Nwin-Nt:Nwin]/Nt
+
+    return ftmat, faxis.data[imins]
+
+
+def get_nearest(ftdata, omegas, val, axes):
+    """Returns 2D spectrum at omega2 nearest to `val` (in 1/cm)
+
+    Equivalent of TwoDSpectrumContainer.get_nearest() for the output
+    of fft_cube() or for responses calculated with projection_matrix();
+    `omegas` are the omega2 values corresponding to the first index of
+    `ftdata` and `axes` are the omega1 and omega3 axes of the spectrum
+
+    """
+    nval = qr.convert(val, "1/cm", "int")
+    imin = numpy.argmin(numpy.abs(omegas - nval))
+
+    spect = qr.TwoDSpectrum()
+    spect.set_axis_1(axes[0])
+    spect.set_axis_3(axes[1])
+    spect.set_data(ftdata[imin,:,:].copy(), dtype=qr.signal_TOTL)
+
+    return spect, imin
+
 
-        if vib_loc == "down":
-            set_vib = [True, False]
-        elif vib_loc == "up":
-            set_vib = [False, True]
-        elif vib_loc == "both":
-            set_vib = [True, True]
-        else:
-            raise Exception("Unknown location of the vibrations")
+def pathways_at(pws, evf, psel, lab, window=0):
+    """Returns pathways of a window with their evolution factors `evf`
 
-        if set_vib[0]:
-            print("Vibrations set for SP_high molecule")
-            mol1.add_Mode(mod1)
-            mod1.set_nmax(0, INP.vibmode["no_g_vib"])
-            mod1.set_nmax(1, INP.vibmode["no_e_vib"])
-            mod1.set_HR(1, HR)
+    """
+    lst = []
+    for kk in psel["indices"][window]:
+        if evf[kk] != 0.0:
+            pw = copy.copy(pws[kk])
+            pw.set_evolution_factor(evf[kk])
+            pw.orientational_averaging(lab)
+            lst.append(pw)
+
+    anl = qr.LiouvillePathwayAnalyzer()
+    anl.pathways = lst
+    return anl.order_by_amplitude(replace=False)
+
+
+def prepare_system(omega, HR, dE, JJ, rate, E0, vib_loc="up", use_vib=True,
+                   detailed_balance=False, temperature=77.0, trimer=None,
+                   disE=None, emode="all"):
+    """Prepares aggregates and evolution superoperator for a set of parameters
+
+    Returns a dictionary with the aggregate including the two-exciton
+    states, the evolution superoperator (in the mode `emode`, not yet
+    calculated) and the objects from which run() calculates the 2D spectra.
+    The item "prop" can be set to a propagator of the evolution
+    superoperator calculated elsewhere (see batch_propagators()).
 
-        if set_vib[1]:
-            print("Vibrations set for B molecule")
-            mol2.add_Mode(mod2)
-            mod2.set_nmax(0, INP.vibmode["no_g_vib"])
-            mod2.set_nmax(1, INP.vibmode["no_e_vib"])
-            mod2.set_HR(1, HR)
+    """
+    use_trimer =  trimer["useit"]
+    rate_sp = trimer["rate"]
 
-    #
-    # Before we build the aggregate, we make its copy to have an unbuilt version
-    #
-    agg3 = agg.deepcopy()
+    try:
+        reuse_aggregates = INP.reuse_aggregates
+    except:
+        reuse_aggregates = False
+
+    # parameters of the SP
+    J2 = None
+    if use_trimer:
+        E2 = trimer["E2"]
+        epsa = (E0+E2)/2.0
+        DE = trimer["DE"]
+        J2 = 0.5*numpy.sqrt(((E0-E2)**2)-(DE**2))
+        ESP2 = epsa + DE/2.0
+        ESP1 = epsa - DE/2.0
+
+    # site energies of the molecules
+    if not use_trimer:
+        energies = [E0, E0+dE]
+        names = ["Monomer 1", "Monomer 2"]
+    else:
+        energies = [ESP2, E0+dE, ESP1]
+        names = ["Monomer 1 (SP_high)", "Monomer 2 (B)", "Monomer 3 (SP_low)"]
+    energies0 = energies
+    if disE is not None:
+        energies = [energies[k]+disE[k] for k in range(len(energies))]
+    for k in range(len(energies)):
+        print(names[k]+" energy:", energies[k], "1/cm")
 
     #
-    # here we build the complete aggregate and its electronic only version
+    # Aggregates are built only once for the parameters other than the site
+    # energies. For other site energies, the built aggregates are copied and
+    # their energies are shifted. The aggregates are built without disorder,
+    # so that a realization does not depend on which one came first
     #
-    agg.build(mult=1)
-    agg_el.build(mult=1)
+    tkey = (omega, HR, JJ, E0, vib_loc, use_vib, str(trimer))
+    if reuse_aggregates and (tkey not in aggregate_templates):
+        tagg, tagg_el, tagg3 = build_aggregates(omega, HR, JJ, energies0,
+                                                vib_loc, use_vib, trimer,
+                                                J2=J2)
+        aggregate_templates[tkey] = (tagg, tagg_el, tagg3, energies0)
+
+    if reuse_aggregates:
+
+        mark = stage_mark()
+        (agg, agg_el, agg3, tenergies) = aggregate_templates[tkey]
+        shifts = [energies[k]-tenergies[k] for k in range(len(energies))]
+        agg = agg.deepcopy()
+        shift_site_energies(agg, shifts)
+        agg_el = agg_el.deepcopy()
+        shift_site_energies(agg_el, shifts)
+        agg3 = agg3.deepcopy()
+        shift_site_energies(agg3, shifts)
+        mark = stage_done("aggregates", mark)
+
+    else:
+
+        agg, agg_el, agg3 = build_aggregates(omega, HR, JJ, energies,
+                                             vib_loc, use_vib, trimer, J2=J2)
+        mark = stage_mark()
 
     # total Hamiltonian
     HH = agg.get_Hamiltonian()
@@ -523,20 +1786,6 @@ def run(omega, HR, dE, JJ, rate, E0, vib_loc="up", use_vib=True,
     t2_time_step = INP.t2_time_step
     time2 = qr.TimeAxis(0.0, t2_N_steps, t2_time_step)
 
-    #
-    # Containers for 2D maps with positive and negative frequencies
-    #
-    cont_p = qr.TwoDResponseContainer(t2axis=time2)
-    cont_m = qr.TwoDResponseContainer(t2axis=time2)
-    cont_tot = qr.TwoDResponseContainer(t2axis=time2)
-
-    #
-    # spectra will be indexed by the times in the time axis `time2`
-    #
-    cont_p.use_indexing_type(time2)
-    cont_m.use_indexing_type(time2)
-    cont_tot.use_indexing_type(time2)
-
     #
     # We define two-time axes, which will be FFTed and will define
     # the omega_1 and omega_3 axes of the 2D spectrum
@@ -620,146 +1869,276 @@ def run(omega, HR, dE, JJ, rate, E0, vib_loc="up", use_vib=True,
     p_deph.convert_to("Lorentzian")
 
     eUt = qr.qm.EvolutionSuperOperator(time2, HH, relt=LF, pdeph=p_deph,
-                                       mode="all")
+                                       mode=emode)
     eUt.set_dense_dt(INP.fine_splitting)
+    stage_done("system_setup", mark)
 
-    print("---")
-
-    #
-    # We calculate evolution superoperator
-    #
-    eUt.calculate(show_progress=False)
+    return dict(agg3=agg3, eUt=eUt, LF=LF, p_deph=p_deph, lab=lab, msc=msc,
+                time2=time2, prop=None)
 
-    # save the evolution operator
-    if save_eUt:
-        eut_name = os.path.join(dname, "eUt"+
-                                    "_omega2="+str(omega)+data_descr+obj_ext)
-        eUt.save(eut_name)
 
-    #
-    # Prepare aggregate with all states (including 2-EX band)
-    #
-    agg3.build(mult=2)
-    agg3.diagonalize()
+#
+################################################################################
+################################################################################
+#
+#  Main simulation routine
+#
+################################################################################
+################################################################################
+#
+def run(omega, HR, dE, JJ, rate, E0, vib_loc="up", use_vib=True,
+        detailed_balance=False, temperature=77.0, stype=qr.signal_REPH,
+        save_eUt=False, t2_save_pathways=[], dname=None, trimer=None,
+        disE=None, maps=default_maps, system=None):
+    """Runs a complete set of simulations for a single set of parameters
 
-    pways = dict()
 
-    olow_cm = omega-INP.omega_uncertainty/2.0
-    ohigh_cm = omega+INP.omega_uncertainty/2.0
-    olow = qr.convert(olow_cm, "1/cm", "int")
-    ohigh = qr.convert(ohigh_cm, "1/cm", "int")
+    If disE is not None it tries to run averaging over Gaussian energetic
+    disorder.
 
-    for t2 in time2.data:
+    Only the omega2 maps listed in `maps` (see `default_maps`) are
+    calculated and returned (in the same order).
 
-        # this could save some memory of pathways become too big
-        pways = dict()
+    """
+    if dname is None:
+        dname = "sim_"+vib_loc
 
-        print("T2 =", t2, "fs (of T2_max =", time2.max, "fs)")
+    normalize_maps_to_maximu = False
+    trim_maps = False
 
-        twod = msc.calculate_one_system(t2, agg3, eUt, lab, pways=pways,
-                                        dtol=1.0e-12,
-                                        selection=[["omega2",[olow, ohigh]]])
-        pws = pways[str(t2)]
-        npa = len(pws)
-        has_R = False
-        has_NR = False
-        for pw in pws:
-            if pw.pathway_type == "NR":
-                has_NR = True
-            elif pw.pathway_type == "R":
-                has_R = True
+    try:
+        omega2_maps_by = INP.omega2_maps_by
+    except:
+        omega2_maps_by = "fft"
+    if omega2_maps_by not in ["fft", "projection", "streaming"]:
+        raise Exception("Unknown omega2_maps_by: "+str(omega2_maps_by))
 
-        if t2 in t2_save_pathways:
-            pws_name = os.path.join(dname, "pws_t2="+str(t2)+
-                                    "_omega2="+str(omega)+data_descr+obj_ext)
-            qr.save_parcel(pways[str(t2)], pws_name)
+    try:
+        t2_propagation = INP.t2_propagation
+    except:
+        t2_propagation = "dense"
+    if t2_propagation not in ["dense", "diagonalization"]:
+        raise Exception("Unknown t2_propagation: "+str(t2_propagation))
 
-        cont_p.set_spectrum(twod)
+    try:
+        eUt_cache = INP.eUt_cache
+    except:
+        eUt_cache = dict(useit=False)
 
-        twod = msc.calculate_one_system(t2, agg3, eUt, lab, pways=pways,
-                                        dtol=1.0e-12,
-                                        selection=[["omega2",[-ohigh, -olow]]])
+    units = "1/cm"
+    with qr.energy_units(units):
 
-        pws = pways[str(t2)]
-        npa = len(pws)
-        #print(" m:", npa)
-        has_R = False
-        has_NR = False
-        for pw in pws:
-            if pw.pathway_type == "NR":
-                has_NR = True
-            elif pw.pathway_type == "R":
-                has_R = True
+        data_descr = "_dO="+str(dE)+"_omega="+str(omega)+ \
+                     "_HR="+str(HR)+"_J="+str(JJ)
 
-        #print(" R:", has_R, ", NR:", has_NR)
+        if use_vib:
+            sys_char = "_vib"
+        else:
+            sys_char = "_ele"
+        data_ext = sys_char+".png"
+        obj_ext = sys_char+".qrp"
 
-        if t2 in t2_save_pathways:
-            pws_name = os.path.join(dname, "pws_t2="+str(t2)+
-                                    "_omega2="+str(-omega)+data_descr+obj_ext)
-            qr.save_parcel(pways[str(t2)], pws_name)
+    #
+    # In the streaming mode, the evolution superoperator is propagated
+    # while the omega2 maps are accumulated, one t2 time at a time
+    #
+    if omega2_maps_by == "streaming":
+        emode = "jit"
+    else:
+        emode = "all"
+
+    if system is None:
+        system = prepare_system(omega, HR, dE, JJ, rate, E0, vib_loc,
+                                use_vib, detailed_balance=detailed_balance,
+                                temperature=temperature, trimer=trimer,
+                                disE=disE, emode=emode)
+    agg3 = system["agg3"]
+    eUt = system["eUt"]
+    LF = system["LF"]
+    p_deph = system["p_deph"]
+    lab = system["lab"]
+    msc = system["msc"]
+    time2 = system["time2"]
 
-        cont_m.set_spectrum(twod)
+    print("---")
+    mark = stage_mark()
 
     #
-    # Save aggregate when a single calculation is done
+    # We calculate evolution superoperator, unless its propagator was
+    # prepared together with other systems (see batch_propagators())
     #
-    if save_eUt:
-        fname = os.path.join(dname, "aggregate.qrp")
-        agg3.save(fname)
+    prop = system["prop"]
+    if prop is not None:
+        if save_eUt:
+            print("Evolution superoperator is not saved for systems"+
+                  " propagated in a batch")
+
+    elif emode == "all":
+        if eUt_cache["useit"]:
+            key = eUt_cache_key(eUt, LF, p_deph, t2_propagation)
+            cached = load_eUt_from_cache(eUt_cache, key, time2)
+        else:
+            cached = None
+
+        if cached is None:
+            if t2_propagation == "diagonalization":
+                n2 = 0
+                dprop = diagonalize_liouvillian(eUt)
+                for Ut in liouvillian_evolution(dprop, time2):
+                    eUt.data[n2,:,:,:,:] = Ut
+                    n2 += 1
+            else:
+                eUt.calculate(show_progress=False)
+            if eUt_cache["useit"]:
+                save_to_cache(eUt_cache, key+"_"+str(time2.length), eUt)
+        else:
+            print("Evolution superoperator loaded from cache")
+            eUt = cached
+
+        # save the evolution operator
+        if save_eUt:
+            eut_name = os.path.join(dname, "eUt"+
+                                    "_omega2="+str(omega)+data_descr+obj_ext)
+            eUt.save(eut_name)
+
+    else:
+        if t2_propagation == "diagonalization":
+            prop = diagonalize_liouvillian(eUt)
+        if save_eUt:
+            print("Evolution superoperator is not saved in the streaming mode")
+
+    mark = stage_done("eUt_calculate", mark,
+                      arrays_MB=propagation_MB(eUt, prop))
 
     #
-    # Window function for subsequenty FFT
+    # Prepare aggregate with all states (including 2-EX band)
     #
-    window = func.Tukey(time2, r=INP.tukey_window_r, sym=False)
+    agg3.diagonalize()
+    mark = stage_done("diagonalize", mark)
+
+    olow_cm = omega-INP.omega_uncertainty/2.0
+    ohigh_cm = omega+INP.omega_uncertainty/2.0
+    olow = qr.convert(olow_cm, "1/cm", "int")
+    ohigh = qr.convert(ohigh_cm, "1/cm", "int")
 
     #
-    # FFT with the window function
+    # Liouville pathways are generated and selected only once; at each t2
+    # we only update their evolution factors
+    #
+    pws = generate_pathways(agg3, eUt, lab, dtol=1.0e-12, prop=prop)
+    # the mask of the superoperator elements and its complex copy
+    mark = stage_done("generate_pathways", mark, pathways=len(pws),
+                      arrays_MB=eUt.dim**4*(numpy.dtype(bool).itemsize+
+                                numpy.dtype(qr.COMPLEX).itemsize)/2.0**20)
+    psel = select_pathways(msc, pws, [[olow, ohigh], [-ohigh, -olow]])
+    elems = pathway_elements(pws)
+    mark = stage_done("select_pathways", mark,
+                      selected=sum([len(ind) for ind in psel["indices"]]),
+                      shapes=len(psel["shapes"]),
+                      arrays_MB=psel["shapes"].nbytes/2.0**20)
+
     #
-    # Specify REPH, NONR or `total` to get different types of spectra
+    # Window function for subsequenty FFT
     #
-    print("Calculating FFT of the 2D maps")
-    #fcont = cont.fft(window=window, dtype=stype) #, dpart="real", offset=0.0)
+    window = func.Tukey(time2, r=INP.tukey_window_r, sym=False)
 
-    fcont_p_re = cont_p.fft(window=window, dtype=qr.signal_REPH)
-    fcont_p_nr = cont_p.fft(window=window, dtype=qr.signal_NONR)
-    fcont_p_to = cont_p.fft(window=window, dtype=qr.signal_TOTL)
+    show_omega = omega
 
-    if normalize_maps_to_maximu:
-        fcont_p_re.normalize2(dpart=qr.part_ABS)
-        fcont_p_nr.normalize2(dpart=qr.part_ABS)
-        fcont_p_to.normalize2(dpart=qr.part_ABS)
+    #
+    # Responses at all t2 times and their FFT with the window function.
+    # Only the combinations of omega2 window (positive (p) or negative (m)
+    # omega2) and signal type which are requested in `maps` are calculated.
+    # With omega2_maps_by == "projection", the line shape weights are
+    # Fourier transformed only at the omega2 values of the maps and
+    # the responses at all t2 times are never formed. With "streaming",
+    # the transformed weights are accumulated during the propagation,
+    # and nothing is stored for all t2 times.
+    #
+    if omega2_maps_by == "fft":
+        print("Calculating 2D maps for", time2.length, "T2 points (T2_max =",
+              time2.max, "fs) and their FFT")
+    else:
+        print("Calculating 2D maps for", time2.length, "T2 points (T2_max =",
+              time2.max, "fs) by projection on omega2")
+        vals = [sign*show_omega for (win, dtype, sign) in maps]
+        ftmat, omegas = projection_matrix(time2, window, vals)
 
-    fcont_m_re = cont_m.fft(window=window, dtype=qr.signal_REPH)
-    fcont_m_nr = cont_m.fft(window=window, dtype=qr.signal_NONR)
-    fcont_m_to = cont_m.fft(window=window, dtype=qr.signal_TOTL)
+    if omega2_maps_by == "streaming":
+        wgt = numpy.zeros((len(vals), len(psel["shapes"])), dtype=qr.COMPLEX)
+    else:
+        evf = numpy.zeros((time2.length, len(pws)), dtype=qr.COMPLEX)
 
-    if normalize_maps_to_maximu:
-        fcont_m_re.normalize2(dpart=qr.part_ABS)
-        fcont_m_nr.normalize2(dpart=qr.part_ABS)
-        fcont_m_to.normalize2(dpart=qr.part_ABS)
+    if instrumentation:
+        stamps = [time.perf_counter()]
+    n2 = 0
+    for evd in evolution_data(eUt, prop):
+        evf_n = evolution_factors(elems, evd)
 
-    if trim_maps:
-        twin = INP.trim_maps_to
-        with qr.energy_units("1/cm"):
-            fcont_p_re.trimall_to(window=twin)
-            fcont_p_nr.trimall_to(window=twin)
-            fcont_p_to.trimall_to(window=twin)
+        t2 = time2.data[n2]
+        if t2 in t2_save_pathways:
+            for (iw, om2) in [(0, omega), (1, -omega)]:
+                pws_name = os.path.join(dname, "pws_t2="+str(t2)+
+                                        "_omega2="+str(om2)+data_descr+obj_ext)
+                qr.save_parcel(pathways_at(pws, evf_n, psel, lab, window=iw),
+                               pws_name)
+
+        if omega2_maps_by == "streaming":
+            wgt += numpy.outer(ftmat[:,n2], pathway_weights(psel, evf_n))
+        else:
+            evf[n2,:] = evf_n
+        n2 += 1
+        if instrumentation:
+            stamps.append(time.perf_counter())
+
+    if instrumentation:
+        t2_steps_done(stamps)
+    if omega2_maps_by == "streaming":
+        mark = stage_done("t2_steps", mark, arrays_MB=wgt.nbytes/2.0**20)
+    else:
+        mark = stage_done("t2_steps", mark, arrays_MB=evf.nbytes/2.0**20)
 
-    show_omega = omega
+    if omega2_maps_by == "projection":
+        wgt = numpy.dot(ftmat, pathway_weights(psel, evf))
+    elif omega2_maps_by == "fft":
+        wgt = pathway_weights(psel, evf)
+    mark = stage_done("pathway_weights", mark)
 
-    with qr.frequency_units("1/cm"):
-        sp1_p_re, show_Npoint1 = fcont_p_re.get_nearest(show_omega)
-        sp2_p_re, show_Npoint2 = fcont_p_re.get_nearest(-show_omega)
-        sp1_p_nr, show_Npoint1 = fcont_p_nr.get_nearest(show_omega)
-        sp2_p_nr, show_Npoint2 = fcont_p_nr.get_nearest(-show_omega)
-        sp1_p_to, show_Npoint1 = fcont_p_to.get_nearest(show_omega)
-        sp2_p_to, show_Npoint2 = fcont_p_to.get_nearest(-show_omega)
-        sp1_m_re, show_Npoint1 = fcont_m_re.get_nearest(show_omega)
-        sp2_m_re, show_Npoint2 = fcont_m_re.get_nearest(-show_omega)
-        sp1_m_nr, show_Npoint1 = fcont_m_nr.get_nearest(show_omega)
-        sp2_m_nr, show_Npoint2 = fcont_m_nr.get_nearest(-show_omega)
-        sp1_m_to, show_Npoint1 = fcont_m_to.get_nearest(show_omega)
-        sp2_m_to, show_Npoint2 = fcont_m_to.get_nearest(-show_omega)
+    #
+    # Save aggregate when a single calculation is done
+    #
+    if save_eUt:
+        fname = os.path.join(dname, "aggregate.qrp")
+        agg3.save(fname)
+        mark = stage_mark()
+
+    windows = dict(p=0, m=1)
+    fconts = dict()
+    for (win, dtype, sign) in maps:
+        if (win, dtype) not in fconts:
+            resp = calculate_response_cube(psel, wgt, windows[win], dtype)
+            mark = stage_done("responses", mark,
+                              arrays_MB=resp.nbytes/2.0**20)
+            if omega2_maps_by == "fft":
+                fconts[win, dtype], omegas = fft_cube(resp, time2, window)
+                mark = stage_done("fft", mark)
+            else:
+                fconts[win, dtype] = resp
+            del resp
+            if normalize_maps_to_maximu:
+                fcont = fconts[win, dtype]
+                fcont /= numpy.max(numpy.abs(fcont))
+
+    axes = (msc.oa1, msc.oa3)
+    spectra = []
+    for (win, dtype, sign) in maps:
+        sp, show_Npoint = get_nearest(fconts[win, dtype], omegas,
+                                      sign*show_omega, axes)
+        if trim_maps and (win == "p"):
+            twin = INP.trim_maps_to
+            with qr.energy_units("1/cm"):
+                sp.trim_to(window=twin)
+        spectra.append(sp)
+    stage_done("maps", mark)
 
     sstm = platform.system()
     #print(sstm)
@@ -768,12 +2147,305 @@ def run(omega, HR, dE, JJ, rate, E0, vib_loc="up", use_vib=True,
         memo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/(1024*1024)
         print("Memory usage: ", memo, "in MB" )
 
-    return (sp1_p_re, sp1_p_nr, sp2_m_re, sp2_m_nr)
+    return tuple(spectra)
 
 #
 #  END OF THE MAIN SIMULATION ROUTINE
 #
 
+
+def run_task(task):
+    """Runs run() for a point of the scan or for disorder realizations
+
+    `task` is a dictionary with the arguments of run() common to all its
+    calculations ("args" and "kwargs"), the site energy shifts ("disEs";
+    one calculation for each of them) and the lines printed before each
+    calculation ("headers"). Disorder realizations in one task are
+    propagated in a batch (see batch_propagators()) with the method
+    "t2_propagation". Returns a list of the spectra of the calculations
+    together with the times they took, the id of the process which
+    calculated them and the profile of their stages (see stage_done()).
+
+    """
+    args = task["args"]
+    kwargs = task["kwargs"]
+    disEs = task["disEs"]
+
+    systems = [None for disE in disEs]
+    if len(disEs) > 1:
+        print("\nPreparing a batch of", len(disEs), "realizations")
+        for kk in range(len(disEs)):
+            systems[kk] = prepare_system(*args,
+                                detailed_balance=kwargs["detailed_balance"],
+                                temperature=kwargs["temperature"],
+                                trimer=kwargs["trimer"], disE=disEs[kk],
+                                emode="jit")
+        mark = stage_mark()
+        props = batch_propagators([sy["eUt"] for sy in systems],
+                                  method=task["t2_propagation"])
+        stage_done("batch_propagators", mark)
+        for kk in range(len(disEs)):
+            systems[kk]["prop"] = props[kk]
+
+    results = []
+    for kk in range(len(disEs)):
+        for line in task["headers"][kk]:
+            print(*line)
+
+        t1 = time.time()
+        spectra = run(*args, disE=disEs[kk], system=systems[kk], **kwargs)
+        systems[kk] = None
+        t2 = time.time()
+        gc.collect()
+        print("... done in",t2-t1,"sec")
+
+        results.append((spectra, t2-t1))
+
+    return results, os.getpid(), take_profile()
+
+
+def task_key(task):
+    """Returns the key under which the cost of `task` is remembered
+
+    The key contains the site energy shifts of the disorder realizations
+    of the task, so that the realizations of different cost (e.g. near
+    a resonance) are told apart.
+
+    """
+    disEs = [None if disE is None else numpy.round(disE, 6).tolist()
+             for disE in task["disEs"]]
+    return str((task["args"], str(task["kwargs"]["trimer"]), disEs))
+
+
+def load_task_costs(fname):
+    """Loads the times of the tasks measured in previous runs
+
+    """
+    try:
+        return qr.load_parcel(fname)
+    except:
+        return dict()
+
+
+def task_order(tasks, costs):
+    """Returns the indices of `tasks` ordered by decreasing estimated cost
+
+    The cost of a task is its time from a previous run; tasks which were
+    not calculated before are assigned the average known cost. Tasks of
+    the same cost keep their order.
+
+    """
+    known = [costs[task_key(task)] for task in tasks
+             if task_key(task) in costs]
+    if len(known) > 0:
+        default = numpy.mean(known)
+    else:
+        default = 1.0
+    est = [costs.get(task_key(task), default) for task in tasks]
+
+    return sorted(range(len(tasks)), key=lambda ii: -est[ii])
+
+
+def schedule_tasks(tasks, config, scheduler="static", costs=None, skip=[]):
+    """Yields indices of the tasks to be calculated by this process
+
+    With `scheduler` "static", the tasks are split into contiguous blocks,
+    one block per MPI process. With "dynamic", they are taken in the order
+    of decreasing estimated cost (see task_order()), and under MPI each
+    process takes the next task from a counter shared by all processes
+    (one-sided MPI communication) whenever it asks for a new task, so that
+    faster processes take more of them. Tasks with indices in `skip`
+    (e.g. done before a restart) are left out; the distribution of
+    the other tasks is not changed by them.
+
+    """
+    if scheduler == "static":
+        for ii in qr.block_distributed_range(0, len(tasks)):
+            if ii not in skip:
+                yield ii
+        return
+
+    order = [ii for ii in task_order(tasks, costs) if ii not in skip]
+    if not config.inparallel:
+        for ii in order:
+            yield ii
+        return
+
+    from mpi4py import MPI
+    comm = config.comm
+    isz = MPI.INT64_T.Get_size()
+    if config.rank == 0:
+        win = MPI.Win.Allocate(isz, isz, comm=comm)
+        win.Lock(0)
+        win.Put(numpy.zeros(1, dtype=numpy.int64), 0)
+        win.Unlock(0)
+    else:
+        win = MPI.Win.Allocate(0, isz, comm=comm)
+    comm.Barrier()
+
+    one = numpy.ones(1, dtype=numpy.int64)
+    nxt = numpy.zeros(1, dtype=numpy.int64)
+    while True:
+        win.Lock(0)
+        win.Fetch_and_op(one, nxt, 0, 0, MPI.SUM)
+        win.Unlock(0)
+        if nxt[0] >= len(order):
+            break
+        yield order[nxt[0]]
+
+    comm.Barrier()
+    win.Free()
+
+
+def map_tasks(tasks, indices, backend="mpi", workers=0):
+    """Yields the results of run_task() for the tasks with `indices`
+
+    `indices` is an iterator (see schedule_tasks()), from which a new
+    index is taken whenever a task can be started. The results are yielded
+    together with the task index, in the order of `indices`. With `backend`
+    "processes", the tasks are calculated by a pool of `workers` local
+    processes (0 means one per available core) and the results are
+    yielded as soon as they arrive. Otherwise, they are calculated one
+    by one in this process (which can be one of the MPI processes started
+    by qrhei).
+
+    """
+    if backend == "processes":
+        if workers <= 0:
+            workers = os.cpu_count()
+        try:
+            # the script is not importable, so that the workers have
+            # to be forked from this process
+            ctx = multiprocessing.get_context("fork")
+        except ValueError:
+            print("Process pool is not available on this platform;"+
+                  " running serially")
+            ctx = None
+
+        if ctx is not None:
+            print("Running tasks in a pool of", workers, "processes")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        mp_context=ctx) as pl:
+                running = dict()
+                done = dict()
+                started = []
+                for ii in indices:
+                    running[pl.submit(run_task, tasks[ii])] = ii
+                    started.append(ii)
+                    if len(running) == workers:
+                        break
+                while len(running) > 0:
+                    (finished, pending) = concurrent.futures.wait(running,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for fut in finished:
+                        done[running.pop(fut)] = fut.result()
+                        ii = next(indices, None)
+                        if ii is not None:
+                            running[pl.submit(run_task, tasks[ii])] = ii
+                            started.append(ii)
+                    while (len(started) > 0) and (started[0] in done):
+                        ii = started.pop(0)
+                        yield ii, done.pop(ii)
+            return
+
+    for ii in indices:
+        yield ii, run_task(tasks[ii])
+
+
+def reduce_sums(arrays, config):
+    """Sums arrays over all processes; the sums are returned on rank 0
+
+    The arrays are packed into one contiguous buffer, so that only one
+    reduction is performed. The processes on the same node first add
+    their buffers into an MPI-3 shared memory window, and only one process
+    per node takes part in the reduction between the nodes. Other ranks
+    receive zeros.
+
+    """
+    if not config.inparallel:
+        return arrays
+
+    from mpi4py import MPI
+    comm = config.comm
+    buf = numpy.concatenate([numpy.ravel(arr) for arr in arrays])
+
+    # node local sum in the shared memory of the first process on the node
+    ncomm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=comm.rank)
+    if ncomm.rank == 0:
+        win = MPI.Win.Allocate_shared(buf.nbytes, buf.itemsize, comm=ncomm)
+    else:
+        win = MPI.Win.Allocate_shared(0, buf.itemsize, comm=ncomm)
+    (mem, isz) = win.Shared_query(0)
+    shared = numpy.ndarray(buffer=mem, dtype=buf.dtype, shape=buf.shape)
+    if ncomm.rank == 0:
+        shared[:] = 0.0
+    ncomm.Barrier()
+    win.Lock(0)
+    shared += buf
+    win.Sync()
+    win.Unlock(0)
+    ncomm.Barrier()
+
+    # sum over the nodes
+    if ncomm.rank == 0:
+        lcomm = comm.Split(0, comm.rank)
+    else:
+        lcomm = comm.Split(MPI.UNDEFINED, comm.rank)
+    total = numpy.zeros(buf.shape, dtype=buf.dtype)
+    if ncomm.rank == 0:
+        lcomm.Reduce(shared, total, op=MPI.SUM, root=0)
+        lcomm.Free()
+    ncomm.Barrier()
+    win.Free()
+    ncomm.Free()
+
+    sums = []
+    ii = 0
+    for arr in arrays:
+        sums.append(total[ii:ii+arr.size].reshape(arr.shape))
+        ii += arr.size
+    return sums
+
+
+def load_balance(records, config, costs=None, fname=None):
+    """Reports load balance statistics and saves the measured task costs
+
+    `records` are (task key, process, time) triplets of the tasks
+    calculated by this process. Under MPI, they are collected from all
+    processes. The times are stored in `costs` and saved into `fname`
+    for the scheduling of later runs.
+
+    """
+    if config.inparallel:
+        allrec = config.comm.gather(records, root=0)
+        if config.rank != 0:
+            return
+        records = [rec for recs in allrec for rec in recs]
+
+    busy = dict()
+    count = dict()
+    for (key, proc, dt) in records:
+        busy[proc] = busy.get(proc, 0.0) + dt
+        count[proc] = count.get(proc, 0) + 1
+    if len(busy) == 0:
+        return
+
+    times = numpy.array(list(busy.values()))
+    print("\nLoad balance:", len(records), "tasks calculated by",
+          len(busy), "processes")
+    for proc in busy:
+        print("   process", proc, ":", count[proc], "tasks in", busy[proc],
+              "sec")
+    print("   busy time min/mean/max:", numpy.min(times), numpy.mean(times),
+          numpy.max(times), "sec")
+    print("   imbalance (max/mean - 1):",
+          numpy.max(times)/numpy.mean(times) - 1.0)
+
+    if fname is not None:
+        for (key, proc, dt) in records:
+            costs[key] = dt
+        qr.save_parcel(costs, fname)
+
 ###############################################################################
 ###############################################################################
 #
@@ -839,6 +2511,61 @@ disorder = INP.disorder
 detailed_balance = INP.detailed_balance
 temperature = INP.temperature
 
+#
+# Parallel backend: "mpi" distributes the calculations over the processes
+# started by qrhei, "processes" (in addition) over a local process pool
+#
+try:
+    parallel_backend = INP.parallel_backend
+except:
+    parallel_backend = "mpi"
+if parallel_backend not in ["mpi", "processes"]:
+    raise Exception("Unknown parallel_backend: "+str(parallel_backend))
+try:
+    parallel_workers = INP.parallel_workers
+except:
+    parallel_workers = 0
+
+#
+# Scheduling of the tasks over the processes; the dynamic scheduler uses
+# the times of the tasks measured in previous runs, which are kept in
+# a file in the directory of the input file (unless its path is absolute),
+# so that they are shared by all runs whatever their output directories
+#
+try:
+    parallel_scheduler = INP.parallel_scheduler
+except:
+    parallel_scheduler = "static"
+if parallel_scheduler not in ["static", "dynamic"]:
+    raise Exception("Unknown parallel_scheduler: "+str(parallel_scheduler))
+try:
+    task_costs_file = INP.task_costs_file
+except:
+    task_costs_file = "task_costs.qrp"
+task_costs_path = os.path.join(os.path.dirname(os.path.abspath(input_file)),
+                               task_costs_file)
+task_costs = load_task_costs(task_costs_path)
+
+#
+# Results of the scan are saved into the result store (see store_maps()) or
+# into spectral containers
+#
+try:
+    result_store = INP.result_store
+except:
+    result_store = "containers"
+if result_store not in ["store", "containers"]:
+    raise Exception("Unknown result_store: "+str(result_store))
+
+#
+# Disorder averages can be calculated from the spectra of an energy gap
+# scan (spectral library) instead of simulating the realizations
+#
+try:
+    library = INP.spectral_library
+except:
+    library = dict(useit=False)
+
 #
 # Run with a single realization (sigle set of parameters)
 #
@@ -895,7 +2622,11 @@ config = qr.distributed_configuration()
 
 parms = parms1
 i_p_re = 0
+records = []
+profiles = dict()
 n_save = 0
+n_chunk = 0
+maps = []
 tags = []
 save_it_at_the_end = False
 
@@ -925,6 +2656,16 @@ for model in models:
         # directory already exists
         pass
 
+    # parameters of the spectra, checked when they are used as a library
+    if config.rank == 0:
+        with open(os.path.join(dname, "model_parameters.json"), "w") as f:
+            json.dump([model_parameters(par, vib_loc) for par in parms], f,
+                      indent=1)
+
+    # maps of previous runs into the same directory are not overwritten
+    if result_store == "store":
+        n_chunk = next_chunk(dname, node=config.rank)
+
     if INP.copy_input_file_to_results:
         if INP._from_file:
             shutil.copy2(input_file, dname)
@@ -952,7 +2693,34 @@ for model in models:
         #
         # loop over disorder
         #
-        if disorder:
+        if disorder and library["useit"]:
+
+            (JJ, dE, trimer) = ptns[0]
+
+            qr.timeit(show_stamp=True)
+
+            if use_trimer:
+                raise Exception("The spectral library can be used with"+
+                                " the dimer model only")
+
+            print("\nAveraging spectra of the energy gap scan in",
+                  library["dir"])
+            check_spectral_library(library["dir"], par, vib_loc)
+            (gaps, lib) = load_spectral_library(library["dir"])
+
+            sigma = INP.disorder_fwhm/(2.0*numpy.sqrt(2.0*numpy.log(2.0)))
+            (av1_p_re, av1_p_nr,
+             av2_m_re, av2_m_nr) = [library_average(gaps, sps, dE, sigma)
+                                    for sps in lib]
+
+            params = dict(J=JJ, dE=dE, E0=E0, omega=omega,
+                          delta=INP.disorder_fwhm)
+            for av in (av1_p_re, av1_p_nr, av2_m_re, av2_m_nr):
+                av.log_params(params)
+
+            qr.finished_in(show_stamp=True)
+
+        elif disorder:
 
             (JJ, dE, trimer) = ptns[0]
 
@@ -964,8 +2732,23 @@ for model in models:
                 Nst = 2
 
             Nreal = INP.N_realizations
+            try:
+                sampling = INP.disorder_sampling
+            except:
+                sampling = "random"
+            if sampling == "gauss-hermite":
+                Nn = gauss_hermite_nodes(Nreal, Nst)
+                if Nn**Nst != Nreal:
+                    Nreal = Nn**Nst
+                    print("Gauss-Hermite quadrature with", Nn, "nodes per"+
+                          " site;", Nreal, "realizations")
+            elif sampling == "sobol":
+                Nn = 2**int(numpy.ceil(numpy.log2(Nreal)))
+                if Nn != Nreal:
+                    Nreal = Nn
+                    print("Sobol sampling with a power of 2 of"+
+                          " realizations;", Nreal, "realizations")
             data_initialized = False
-            disM = numpy.zeros((Nst,Nreal))
             sigma = INP.disorder_fwhm/(2.0*numpy.sqrt(2.0*numpy.log(2.0)))
 
             if INP.random_state["reset"]:
@@ -978,89 +2761,259 @@ for model in models:
                 random_state = numpy.random.get_state()
                 qr.save_parcel(random_state, INP.random_state["file"])
 
-            for ri in range(Nreal):
-                disM[:,ri] = sigma*numpy.random.randn(Nst)
+            #
+            # Restart from the checkpoints of an interrupted averaging; each
+            # process continues the sums of the process with the same rank
+            #
+            try:
+                checkpoint_every = INP.disorder_checkpoint_every
+            except:
+                checkpoint_every = 0
+            try:
+                adaptive = INP.adaptive_disorder
+            except:
+                adaptive = dict(useit=False)
+            if adaptive["useit"] and (sampling == "gauss-hermite"):
+                raise Exception("Adaptive disorder averaging cannot be used"+
+                                " with Gauss-Hermite quadrature")
+            accs = [None, None, None, None]
+            ckpts = dict()
+            if INP.restart_disorder:
+                ckpts = load_checkpoints(dname)
+                if len(ckpts) == 0:
+                    print("No checkpoints found in", dname,
+                          "; starting the averaging from the beginning")
+            done = set()
+            my_done = []
+            for node in sorted(ckpts):
+                ckpt = ckpts[node]
+                if ckpt["Nreal"] != Nreal:
+                    raise Exception("Checkpoints of an averaging over"+
+                                    " different number of realizations")
+                done.update(ckpt["done"])
+                if (node % config.size == config.rank) and \
+                   (ckpt["sums"] is not None):
+                    if not data_initialized:
+                        (av1_p_re, av1_p_nr, av2_m_re, av2_m_nr) = ckpt["sums"]
+                        data_initialized = True
+                    else:
+                        av1_p_re.data += ckpt["sums"][0].data
+                        av1_p_nr.data += ckpt["sums"][1].data
+                        av2_m_re.data += ckpt["sums"][2].data
+                        av2_m_nr.data += ckpt["sums"][3].data
+                    if adaptive["useit"]:
+                        if ("welford" not in ckpt) or \
+                           ((ckpt["welford"][0] is None) and
+                            (len(ckpt["done"]) > 0)):
+                            raise Exception("Checkpoints of a non-adaptive"+
+                                            " averaging cannot be continued"+
+                                            " adaptively")
+                        accs = [welford_combine(accs[k], ckpt["welford"][k])
+                                for k in range(4)]
+                    my_done += ckpt["done"]
+            if len(ckpts) > 0:
+                # the same disorder as in the interrupted averaging
+                numpy.random.set_state(ckpts[min(ckpts)]["random_state"])
+                print("Restarting with", len(done), "of", Nreal,
+                      "realizations done")
+
+            rng_state = numpy.random.get_state()
+            (disM, weights) = disorder_samples(Nst, Nreal, sigma, sampling)
+
+            #
+            # Realizations can be prepared and propagated in batches
+            #
+            try:
+                Nbatch = INP.disorder_batch_size
+            except:
+                Nbatch = 1
+            try:
+                t2_propagation = INP.t2_propagation
+            except:
+                t2_propagation = "dense"
+            if Nreal == 1:
+                Nbatch = 1
+
+            # only save the propagator if we calculate a single realization
+            if (Nreal == 1):
+                save_eUt = True
+            else:
+                save_eUt = False
 
             #
             # PARALLEL (if ON) LOOP OVER DISORDER
             #
-            for ds in qr.block_distributed_range(0,Nreal):
-                # generating random numbers
-                disE = numpy.zeros(Nst,dtype=qr.REAL)
-
-                if Nreal > 1:
-                    disE[:] = disM[:,ds]
-
-                print("\nCalculating disordered spectra ... (",ds+1,"of",Nreal,
-                      ") [run ",kk,"of",Np,"]")
-                print("---")
-                print("Temperature =", temperature,"K")
-                #print("JJ =", JJ, "1/cm")
-                print("dE =", dE, "1/cm")
-                print("Disorder in energies: ", disE, "1/cm")
-
-                t1 = time.time()
-
-                # only save the propagator if we calculate a single realization
-                if (Nreal == 1):
-                    save_eUt = True
+            # In the adaptive mode, the realizations are calculated in rounds
+            # (of whole batches), and the averaging stops when the relative
+            # standard error of all maps falls below the tolerance
+            #
+            if adaptive["useit"]:
+                Nround = Nbatch*int(numpy.ceil(adaptive["check_every"]
+                                               /Nbatch))
+            else:
+                Nround = Nreal
+            ntask_done = 0
+            nstart = 0
+            converged = False
+            history = []
+            while (nstart < Nreal) and (not converged):
+                nend = min(nstart+Nround, Nreal)
+
+                tasks = []
+                treals = []
+                skip = []
+                for ib in range(nstart, nend, Nbatch):
+                    disEs = []
+                    headers = []
+                    reals = [ds for ds in range(ib, min(ib+Nbatch, nend))
+                             if ds not in done]
+                    if len(reals) == 0:
+                        skip.append(len(tasks))
+                    for ds in reals:
+                        # generating random numbers
+                        disE = numpy.zeros(Nst,dtype=qr.REAL)
+
+                        if Nreal > 1:
+                            disE[:] = disM[:,ds]
+
+                        disEs.append(disE)
+                        headers.append([("\nCalculating disordered spectra"+
+                                         " ... (", ds+1,"of",Nreal,") [run ",
+                                         kk,"of",Np,"]"),
+                                        ("---",),
+                                        ("Temperature =", temperature,"K"),
+                                        ("dE =", dE, "1/cm"),
+                                        ("Disorder in energies: ", disE,
+                                         "1/cm")])
+
+                    kwargs = dict(save_eUt=save_eUt,
+                                  t2_save_pathways=t2_save_pathways,
+                                  dname=dname, trimer=trimer,
+                                  detailed_balance=detailed_balance,
+                                  temperature=temperature, maps=default_maps)
+                    tasks.append(dict(args=(omega, HR, dE, JJ, rate, E0,
+                                            vib_loc, use_vib),
+                                      kwargs=kwargs, disEs=disEs,
+                                      headers=headers,
+                                      t2_propagation=t2_propagation))
+                    treals.append(reals)
+
+                # results are streamed back as the tasks are finished
+                indices = schedule_tasks(tasks, config, parallel_scheduler,
+                                         task_costs, skip=skip)
+                results = map_tasks(tasks, indices, parallel_backend,
+                                    parallel_workers)
+                for (ii, (task_results, pid, prof)) in results:
+                    records.append((task_key(tasks[ii]), (config.rank, pid),
+                                    sum([tr for (sp, tr) in task_results])))
+                    merge_profiles(profiles.setdefault((config.rank, pid),
+                                                       new_profile()), prof)
+
+                    for (jj, ((sp1_p_re, sp1_p_nr, sp2_m_re, sp2_m_nr), tr)) \
+                        in enumerate(task_results):
+
+                        if not data_initialized:
+                            params = dict(J=JJ, dE=dE, E0=E0, omega=omega,
+                                          delta=INP.disorder_fwhm)
+                            sp1_p_re.log_params(params)
+                            sp1_p_nr.log_params(params)
+                            sp2_m_re.log_params(params)
+                            sp2_m_nr.log_params(params)
+
+                            av1_p_re = sp1_p_re.deepcopy()
+                            av1_p_nr = sp1_p_nr.deepcopy()
+                            av2_m_re = sp2_m_re.deepcopy()
+                            av2_m_nr = sp2_m_nr.deepcopy()
+
+                            av1_p_re.data[:,:] = 0.0
+                            av1_p_nr.data[:,:] = 0.0
+                            av2_m_re.data[:,:] = 0.0
+                            av2_m_nr.data[:,:] = 0.0
+
+                            data_initialized = True
+
+                        # weight of the realization (see disorder_samples())
+                        ww = weights[treals[ii][jj]]
+                        av1_p_re.data += ww*sp1_p_re.data
+                        av1_p_nr.data += ww*sp1_p_nr.data
+                        av2_m_re.data += ww*sp2_m_re.data
+                        av2_m_nr.data += ww*sp2_m_nr.data
+
+                        # statistics are needed by adaptive averaging only
+                        if adaptive["useit"]:
+                            spd = (sp1_p_re, sp1_p_nr, sp2_m_re, sp2_m_nr)
+                            accs = [welford_update(accs[k], ww*spd[k].data)
+                                    for k in range(4)]
+
+                        tags.append(i_p_re)
+
+                        i_p_re +=1
+                        kp += 1
+
+                    #
+                    # checkpoints are saved after complete tasks only
+                    #
+                    my_done += treals[ii]
+                    ntask_done += 1
+                    if (checkpoint_every > 0) and \
+                       (numpy.mod(ntask_done, checkpoint_every) == 0):
+                        save_checkpoint(dict(sums=(av1_p_re, av1_p_nr,
+                                                   av2_m_re, av2_m_nr),
+                                             welford=accs, done=my_done,
+                                             Nreal=Nreal,
+                                             random_state=rng_state),
+                                        dname, node=config.rank)
+
+                nstart = nend
+
+                if adaptive["useit"]:
+                    (nall, errs) = convergence(accs, config)
+                    history.append([nall]+errs)
+                    print("\nRealizations:", nall, "; relative standard"+
+                          " errors of the maps:", errs)
+                    if config.rank == 0:
+                        save_convergence(history, dname)
+                    converged = ((nall >= adaptive["min_realizations"])
+                                 and (max(errs) < adaptive["tolerance"]))
+                    if converged:
+                        print("Disorder averaging converged with", nall,
+                              "realizations")
+
+            if checkpoint_every > 0:
+                if data_initialized:
+                    sums = (av1_p_re, av1_p_nr, av2_m_re, av2_m_nr)
                 else:
-                    save_eUt = False
-
-                (sp1_p_re, sp1_p_nr, sp2_m_re, sp2_m_nr) = \
-                run(omega, HR, dE, JJ, rate, E0, vib_loc, use_vib,
-                    save_eUt=save_eUt,t2_save_pathways=t2_save_pathways,
-                    dname=dname, trimer=trimer, disE=disE,
-                    detailed_balance=detailed_balance,temperature=temperature)
-
-                t2 = time.time()
-                gc.collect()
-                print("... done in",t2-t1,"sec")
-
+                    sums = None
+                save_checkpoint(dict(sums=sums, welford=accs, done=my_done,
+                                     Nreal=Nreal, random_state=rng_state),
+                                dname, node=config.rank)
+
+            # processes which got no realizations contribute zeros
+            if config.inparallel:
+                have = config.comm.allgather(data_initialized)
+                src = have.index(True)
+                zeros = None
+                if config.rank == src:
+                    zeros = [av.deepcopy() for av in (av1_p_re, av1_p_nr,
+                                                      av2_m_re, av2_m_nr)]
+                    for av in zeros:
+                        av.data[:,:] = 0.0
+                zeros = config.comm.bcast(zeros, root=src)
                 if not data_initialized:
-                    params = dict(J=JJ, dE=dE, E0=E0, omega=omega,
-                                  delta=INP.disorder_fwhm)
-                    sp1_p_re.log_params(params)
-                    sp1_p_nr.log_params(params)
-                    sp2_m_re.log_params(params)
-                    sp2_m_nr.log_params(params)
-
-                    if INP.restart_disorder:
-                        fname = os.path.join(dname, "ave_p_re.qrp")
-                        av1_p_re = qr.load_parcel(fname)
-                        fname = os.path.join(dname, "ave_p_nr.qrp")
-                        av1_p_nr = qr.load_parcel(fname)
-                        fname = os.path.join(dname, "ave_m_re.qrp")
-                        av2_m_re = qr.load_parcel(fname)
-                        fname = os.path.join(dname, "ave_m_nr.qrp")
-                        av2_m_nr = qr.load_parcel(fname)
-                    else:
-                        av1_p_re = sp1_p_re.deepcopy()
-                        av1_p_nr = sp1_p_nr.deepcopy()
-                        av2_m_re = sp2_m_re.deepcopy()
-                        av2_m_nr = sp2_m_nr.deepcopy()
-
-                        av1_p_re.data[:,:] = 0.0
-                        av1_p_nr.data[:,:] = 0.0
-                        av2_m_re.data[:,:] = 0.0
-                        av2_m_nr.data[:,:] = 0.0
-
-                    data_initialized = True
+                    (av1_p_re, av1_p_nr, av2_m_re, av2_m_nr) = zeros
 
-                av1_p_re.data += sp1_p_re.data
-                av1_p_nr.data += sp1_p_nr.data
-                av2_m_re.data += sp2_m_re.data
-                av2_m_nr.data += sp2_m_nr.data
-
-                tags.append(i_p_re)
-
-                i_p_re +=1
-                kp += 1
+            # number of realizations in the average
+            if adaptive["useit"]:
+                Nave = len(my_done)
+                if config.inparallel:
+                    Nave = sum(config.comm.allgather(Nave))
+            else:
+                Nave = Nreal
 
-            av1_p_re.data = config.reduce(av1_p_re.data)/Nreal
-            av1_p_nr.data = config.reduce(av1_p_nr.data)/Nreal
-            av2_m_re.data = config.reduce(av2_m_re.data)/Nreal
-            av2_m_nr.data = config.reduce(av2_m_nr.data)/Nreal
+            avs = (av1_p_re, av1_p_nr, av2_m_re, av2_m_nr)
+            sums = reduce_sums([av.data for av in avs], config)
+            for (av, data) in zip(avs, sums):
+                av.data = data/Nave
 
             qr.finished_in(show_stamp=True)
 
@@ -1072,30 +3025,46 @@ for model in models:
             #
             # PARALLEL (if ON) LOOP OVER PARAMETER RANGE
             #
-            for (JJ, dE, trimer) in qr.block_distributed_list(ptns):
-
-                print("\nCalculating spectra ... (",kp,"of",Nje,
-                      ") [run ",kk,"of",Np,"]")
-                print("---")
-                print("Temperature =", temperature,"K")
-                #print("JJ =", JJ, "1/cm")
-                print("dE =", dE, "1/cm")
-
-                t1 = time.time()
-                if Nje == 1:
-                    save_eUt = True
-                else:
-                    save_eUt = False
-
-                (sp1_p_re, sp1_p_nr, sp2_m_re, sp2_m_nr) = \
-                run(omega, HR, dE, JJ, rate, E0, vib_loc, use_vib,
-                    save_eUt=save_eUt, t2_save_pathways=t2_save_pathways,
-                    dname=dname, trimer=trimer,
-                    detailed_balance=detailed_balance, temperature=temperature)
+            if Nje == 1:
+                save_eUt = True
+            else:
+                save_eUt = False
+
+            tasks = []
+            for (JJ, dE, trimer) in ptns:
+                kwargs = dict(save_eUt=save_eUt,
+                              t2_save_pathways=t2_save_pathways,
+                              dname=dname, trimer=trimer,
+                              detailed_balance=detailed_balance,
+                              temperature=temperature, maps=default_maps)
+                headers = [("\nCalculating spectra ... (",len(tasks)+1,"of",
+                            Nje,") [run ",kk,"of",Np,"]"),
+                           ("---",),
+                           ("Temperature =", temperature,"K"),
+                           ("dE =", dE, "1/cm")]
+                tasks.append(dict(args=(omega, HR, dE, JJ, rate, E0, vib_loc,
+                                        use_vib),
+                                  kwargs=kwargs, disEs=[None],
+                                  headers=[headers]))
 
-                t2 = time.time()
-                gc.collect()
-                print("... done in",t2-t1,"sec")
+            #
+            # results are streamed back as the tasks are finished; the spectra
+            # are tagged by the index of the point, so that they can be
+            # ordered whichever process calculated them
+            #
+            i_p_re0 = i_p_re
+            indices = schedule_tasks(tasks, config, parallel_scheduler,
+                                     task_costs)
+            for (ii, (task_results, pid, prof)) in map_tasks(tasks, indices,
+                                                        parallel_backend,
+                                                        parallel_workers):
+                records.append((task_key(tasks[ii]), (config.rank, pid),
+                                task_results[0][1]))
+                merge_profiles(profiles.setdefault((config.rank, pid),
+                                                   new_profile()), prof)
+
+                (JJ, dE, trimer) = ptns[ii]
+                (sp1_p_re, sp1_p_nr, sp2_m_re, sp2_m_nr) = task_results[0][0]
 
                 params = dict(J=JJ, dE=dE, E0=E0, omega=omega)
                 sp1_p_re.log_params(params)
@@ -1103,22 +3072,36 @@ for model in models:
                 sp2_m_re.log_params(params)
                 sp2_m_nr.log_params(params)
 
-                cont_p_re.set_spectrum(sp1_p_re, tag=i_p_re)
-                cont_p_nr.set_spectrum(sp1_p_nr, tag=i_p_re)
-                cont_m_re.set_spectrum(sp2_m_re, tag=i_p_re)
-                cont_m_nr.set_spectrum(sp2_m_nr, tag=i_p_re)
-                tags.append(i_p_re)
-
+                itag = i_p_re0 + ii
+                tags.append(itag)
                 n_save += 1
-                if not save_it_at_the_end:
 
+                if result_store == "store":
+
+                    # the maps are appended to the store in chunks
+                    maps.append((itag, (sp1_p_re, sp1_p_nr,
+                                        sp2_m_re, sp2_m_nr)))
                     if numpy.mod(n_save,10) == 0:
+                        store_maps(maps, dname, node=config.rank,
+                                   chunk=n_chunk)
+                        n_chunk += 1
+                        maps = []
+
+                else:
+
+                    cont_p_re.set_spectrum(sp1_p_re, tag=itag)
+                    cont_p_nr.set_spectrum(sp1_p_nr, tag=itag)
+                    cont_m_re.set_spectrum(sp2_m_re, tag=itag)
+                    cont_m_nr.set_spectrum(sp2_m_nr, tag=itag)
+
+                    if (not save_it_at_the_end) and \
+                       (numpy.mod(n_save,10) == 0):
                         # we save and release containers after some time
                         print("Saving intermediate results; cleaning memory")
                         cont = (cont_p_re, cont_p_nr, cont_m_re, cont_m_nr)
                         save_containers(cont, dname, node=config.rank)
                         (cont_p_re, cont_p_nr,
-                        cont_m_re, cont_m_nr) = init_containers()
+                         cont_m_re, cont_m_nr) = init_containers()
 
                 i_p_re +=1
                 kp += 1
@@ -1130,6 +3113,14 @@ tB = time.time()
 at = '{0:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now())
 print("\n... finished simulation set at", at, "in", tB-tA,"sec")
 
+if parallel_scheduler == "dynamic":
+    load_balance(records, config, task_costs, task_costs_path)
+else:
+    load_balance(records, config)
+
+if instrumentation:
+    save_profile(profiles, dname, config)
+
 #
 ################################################################################
 #  Final clean-up
@@ -1141,6 +3132,10 @@ if disorder:
         cont = (av1_p_re, av1_p_nr, av2_m_re, av2_m_nr)
         save_averages(cont, dname)
 
+elif result_store == "store":
+    if len(maps) > 0:
+        store_maps(maps, dname, node=config.rank, chunk=n_chunk)
+
 else:
     if save_it_at_the_end:
         rank = config.rank